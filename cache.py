@@ -0,0 +1,98 @@
+"""
+A persistent on-disk cache of processed profiles.
+
+Each snapshot is a pickled Profile, keyed by the location, size and
+modification time of its TSDB tables, the options that affect how the
+results are processed (including which items are being compared), and
+the fingerprint of the grammar's lexicon.
+"""
+
+import os
+import sys
+import hashlib
+import cPickle as pickle
+
+from profile import Profile, find_profile_path
+
+
+# bump this whenever a change is made to what a Profile contains
+CACHE_VERSION = 3
+
+TABLES = ('relations', 'item', 'parse', 'result')
+
+
+class ProfileCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # already exists, possibly made by another worker
+            if not os.path.isdir(cache_dir):
+                raise
+
+    def get_key(self, profile_path, grammar, gopts):
+        item_ids = gopts.item_ids
+        if item_ids is not None:
+            item_ids = sorted(item_ids)
+        parts = [CACHE_VERSION, os.path.abspath(profile_path), gopts.nbest, 
+                 gopts.use_errors, item_ids, grammar.name, grammar.version, 
+                 grammar.lexicon_fingerprint]
+        for table in TABLES:
+            path = os.path.join(profile_path, table)
+            for table_path in (path, path + '.gz'):
+                if os.path.exists(table_path):
+                    stat = os.stat(table_path)
+                    parts.extend([table_path, stat.st_size, stat.st_mtime])
+        return hashlib.md5(repr(parts)).hexdigest()
+
+    def load_profile(self, profile_name, grammar, gopts):
+        """
+        Returns the Profile for the profile name and grammar, reading
+        it from the cache if there is an up to date snapshot, otherwise
+        processing the profile and saving a snapshot of it.
+        """
+        profile_path = find_profile_path(profile_name, grammar, gopts)
+        key = self.get_key(profile_path, grammar, gopts)
+        path = os.path.join(self.cache_dir, key + '.pickle')
+        profile = self.read(path)
+        if profile is None:
+            profile = Profile(profile_name, grammar, gopts, profile_path)
+            self.write(path, profile)
+        else:
+            profile.attach(grammar, gopts)
+        return profile
+
+    def read(self, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as file:
+                return pickle.load(file)
+        except Exception, err:
+            msg = "Ignoring unreadable cached profile {0}: {1}"
+            print >>sys.stderr, msg.format(path, err)
+            return None
+
+    def write(self, path, profile):
+        # write to a temporary file first so that concurrent readers
+        # never see a partial snapshot
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as file:
+                pickle.dump(profile, file, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except (IOError, OSError), err:
+            msg = "Could not write cached profile {0}: {1}"
+            print >>sys.stderr, msg.format(path, err)
+
+
+def load_profile(profile_name, grammar, gopts):
+    """
+    Returns the processed Profile, going through the profile cache if
+    one has been configured.
+    """
+    if gopts.cache_dir is None:
+        return Profile(profile_name, grammar, gopts)
+    return ProfileCache(gopts.cache_dir).load_profile(profile_name, grammar, 
+                                                      gopts)
@@ -1,34 +1,93 @@
 from __future__ import division
 
 try:
-    from scipy import zeros, mean
-    from scipy.spatial.distance import sqeuclidean, squareform, pdist
+    import numpy
+    from scipy import sparse
+    from scipy.cluster import hierarchy
+    from scipy.spatial.distance import sqeuclidean, squareform
     SCIPY = True
 except ImportError:
     SCIPY = False    
     
 import random
-import copy
 import itertools
+import multiprocessing
+
+from profile import VOCAB
+
+
+# relative tolerance within which distances are considered equal
+DISTANCE_TOLERANCE = 1e-9
+
+# categories with more items than gopts.sample_size are clustered with
+# mini-batch k-means and their silhouettes estimated from a sample of
+# that many items, chosen using this seed
+SAMPLE_SEED = 0
+MINIBATCH_SIZE = 1000
+MINIBATCH_ITERATIONS = 100
+MINIBATCH_TOLERANCE = 1e-8
+SILHOUETTE_CHUNK = 1000
+
+# size in pixels of the drawings of the trees of agglomerative clustering
+DENDROGRAM_LEAF_WIDTH = 40
+DENDROGRAM_HEIGHT = 150
+DENDROGRAM_MARGIN = 10
 
 
 class Results():
-    def __init__(self, sil, clusters):
+    def __init__(self, sil, clusters, dendrogram=None):
         self.sil = sil
         self.clusters = clusters
+        self.dendrogram = dendrogram
+
+    def count_attributes(self, matrix):
+        """
+        Counts the number of items of each cluster that have each
+        attribute, using the category's ItemMatrix, saving a dict of
+        the counts of each attribute ID as the cluster's
+        attribute_counts, and their totals over all the clusters.
+        """
+        groups = [[point.row for point in cluster.points] 
+                  for cluster in self.clusters]
+        all_counts = {}
+        for cluster, counts in zip(self.clusters, 
+                                   matrix.group_column_sums(groups, True)):
+            cluster.attribute_counts = counts
+            for attribute_id, count in counts.iteritems():
+                all_counts[attribute_id] = (all_counts.get(attribute_id, 0) + 
+                                            count)
+        self.attribute_counts = all_counts
+        self.num_items = sum(len(cluster) for cluster in self.clusters)
 
 
 class Point:
     """The Point class represents points in n-dimensional space"""
     # Instance variables
-    # self.coords is a list of coordinates for this Point
+    # self.coords is a list of coordinates for this Point (a sparse row
+    #   matrix for the Points of items when using scipy)
     # self.n is the number of dimensions this Point lives in (ie, its space)
     # self.item is an object bound to this Point
+    # self.row is the item's row in the ItemMatrix
+    # self.index is the Point's position in the list of points being
+    #   clustered, and so its row in the array of distances
+    # self.members is a list of the (item, row) of every item with these
+    #   coords, when a single Point stands for all of them, the first
+    #   of which is the Point's item and row
+    # self.weight is the number of items the Point stands for
     # Initialize new Points
-    def __init__(self, coords, item=None):
+    def __init__(self, coords, item=None, row=None, members=None):
         self.coords = coords
-        self.n = len(coords)
+        if SCIPY and sparse.issparse(coords):
+            self.n = coords.shape[1]
+        else:
+            self.n = len(coords)
+        if members is not None:
+            item, row = members[0]
         self.item = item
+        self.row = row
+        self.members = members
+        self.weight = 1 if members is None else len(members)
+        self.index = None
         if item != None:
             self.id = item.id
 
@@ -41,21 +100,18 @@ class Point:
     def __len__(self):
         return self.n
 
-    def __deepcopy__(self, memo):
-        # When we do a deep copy of a point, we only need to copy the coords.
-        # In particular, we don't want to copy the item.
-        return Point(copy.deepcopy(self.coords, memo), self.item)
-
 
 class Cluster:
     """The Cluster class represents clusters of points in n-dimensional space"""
 
-    def __init__(self, points):
+    def __init__(self, points, centroid=None):
         if len(points) == 0: 
             raise Exception("Empty cluster")
         self.points = points
         self.n = points[0].n
-        self.centroid = self.calculate_centroid()
+        if centroid is None:
+            centroid = self.calculate_centroid()
+        self.centroid = centroid
 
     def __len__(self):
         return len(self.points)
@@ -71,43 +127,44 @@ class Cluster:
         return get_distance(old_centroid, self.centroid)
   
     def calculate_centroid(self):
-        """Returns the average of all Points in the Cluster"""
-        return get_average_point(self.points)
+        """Returns the average of all items in the Cluster"""
+        return get_average_point(self.points, weighted=True)
 
     def finalize(self):
         """ Finds the nearest item to the centroid."""
         centroid_dist = lambda x:get_distance(self.centroid, x)
         self.nearest_point = min(self.points, key=centroid_dist)                              
 
-    def get_metrics(self, top_attributes, clusters):
+    def get_metrics(self, top_attributes, results):
         """
         Calculate the cohesion and overlap of each attribute in the top
         fatures.  Cohesion is the percentage of items in this cluster
         that have contain the attribute.  Overlap is the percentage of
-        items in all other clusters that contain the attribute.
+        items in all other clusters that contain the attribute. Both
+        are looked up in the attribute counts of the Results, as made
+        by Results.count_attributes.
         """
-        num_top_feats = len(top_attributes)
-        cohesions = [0] * num_top_feats
-        overlaps = [0] * num_top_feats
-        all_items = 0
-        for cluster in clusters:
-            for point in cluster.points:
-                all_items += 1
-                for i,feat in enumerate(top_attributes):            
-                    if feat in point.item.attributes:
-                        if cluster is self:
-                            cohesions[i] += 1
-                        else:
-                            overlaps[i] += 1
+        top_ids = [VOCAB.ids[feat] for feat in top_attributes]
+        this_counts = self.attribute_counts
+        all_counts = results.attribute_counts
+        cohesions = [this_counts.get(i, 0) for i in top_ids]
+        overlaps = [all_counts.get(i, 0) - this_counts.get(i, 0) 
+                    for i in top_ids]
         this_items = len(self)
-        other_items = all_items - this_items
+        other_items = results.num_items - this_items
         return [(f, c/this_items, o/other_items) 
                 for f,c,o in zip(top_attributes, cohesions, overlaps)]
 
 
 def get_distance_scipy(a, b):
     """Get the squared Euclidean distance between two Points using scipy"""
-    return sqeuclidean(a.coords, b.coords)
+    return sqeuclidean(get_dense_coords(a), get_dense_coords(b))
+
+
+def get_dense_coords(point):
+    if sparse.issparse(point.coords):
+        return point.coords.toarray().ravel()
+    return point.coords
 
     
 def get_distance_manual(a, b):
@@ -118,11 +175,24 @@ def get_distance_manual(a, b):
 
 def get_all_distances_scipy(points):
     """Calculate the squared Euclidean distance between all points using scipy"""
-    matrix = squareform(pdist([p.coords for p in points], 'sqeuclidean'))
-    distances = {}
-    for i,m in enumerate(points):
-        for j,n in enumerate(points[:i]):
-            distances[(m.id, n.id)] = matrix[i][j]
+    coords = get_coords_matrix(points)
+    return get_pairwise_distances(coords, get_squared_norms(coords))
+
+
+def get_pairwise_distances(coords, norms):
+    """
+    Returns the square array of squared Euclidean distances between the
+    rows of a sparse matrix of points' coordinates, given their squared
+    norms.
+    """
+    # |x - y|^2 = |x|^2 + |y|^2 - 2x.y, so only the sparse dot products
+    # of the points are needed
+    # the result is a square array, indexed by the points' positions in
+    # the list, as given by their index attribute
+    distances = (norms[:, None] + norms[None, :] - 
+                 2 * (coords * coords.T).toarray())
+    numpy.maximum(distances, 0, out=distances)
+    numpy.fill_diagonal(distances, 0)
     return distances
     
 
@@ -135,19 +205,50 @@ def get_all_distances_manual(points):
     return distances
 
 
-def get_average_point_scipy(points):
-    return Point(mean([p.coords for p in points], axis=0))
+def get_average_point_scipy(points, weighted=False):
+    """
+    Returns the average of the Points, or with weighted, of the items
+    they stand for.
+    """
+    if not weighted:
+        return Point(get_coords_matrix(points).mean(axis=0).A1)
+    weights = numpy.array([p.weight for p in points], dtype=float)
+    return Point(get_coords_matrix(points).T.dot(weights) / weights.sum())
+
+
+def get_coords_matrix(points):
+    """Returns a sparse matrix with the coords of each Point as a row."""
+    return sparse.vstack([p.coords for p in points], format='csr')
+
 
+def get_squared_norms(coords):
+    return numpy.asarray(coords.multiply(coords).sum(axis=1)).ravel()
 
-def get_average_point_manual(points):
-    num_points = len(points[0])
-    average_coords = [0]*num_points
-    for i in range(num_points):
-        tot = sum(point.coords[i] for point in points)
-        average_coords[i] = tot / num_points
+
+def get_average_point_manual(points, weighted=False):
+    num_coords = len(points[0])
+    if weighted:
+        weights = [point.weight for point in points]
+    else:
+        weights = [1] * len(points)
+    total_weight = sum(weights)
+    average_coords = [0]*num_coords
+    for i in range(num_coords):
+        tot = sum(point.coords[i] * weight 
+                  for point, weight in zip(points, weights))
+        average_coords[i] = tot / total_weight
     return Point(average_coords)
 
 
+def get_weighted_mean(coords, weights, members):
+    """
+    Returns the mean of the rows of the sparse coords matrix given by
+    the indices members, weighted by weights.
+    """
+    member_weights = weights[members]
+    return coords[members].T.dot(member_weights) / member_weights.sum()
+
+
 if SCIPY:
     get_all_distances = get_all_distances_scipy
     get_average_point = get_average_point_scipy
@@ -181,14 +282,18 @@ def get_seeds_det(points, k):
     return points[:k]
 
 
-def get_seeds(points, k):
+def get_seeds(points, k, rng=None):
     """
     Seeds are selected like this: The first seed is taken at random,
     the second is the furthest point from the initial seed. The third
     is the furthest from the average of points 1 and 2... the nth is
     the furthers point away from the average of the first n-1 points.
+    The first seed is chosen using the random.Random rng if one is
+    given.
     """
-    p = random.choice(points)
+    if rng is None:
+        rng = random
+    p = rng.choice(points)
     points = [x for x in points if x is not p]
     initial_points = [p]
     for i in range(k - 1):
@@ -200,9 +305,223 @@ def get_seeds(points, k):
     return initial_points
 
 
-def kmeans(points, k):
+def get_seeds_scipy(coords, norms, k, rng=None):
+    """
+    Vectorised version of get_seeds, taking a sparse matrix of the
+    points' coordinates and their squared norms and returning the
+    indices of the seeds. The first seed is chosen using the numpy
+    RandomState rng if one is given.
+    """
+    if rng is None:
+        seed = random.choice(range(coords.shape[0]))
+    else:
+        seed = rng.randint(coords.shape[0])
+    remaining = numpy.ones(coords.shape[0], dtype=bool)
+    remaining[seed] = False
+    seeds = [seed]
+    for i in range(k - 1):
+        average = coords[seeds].mean(axis=0).A1
+        distances = get_centroid_distances(coords, norms, [average])[:, 0]
+        distances[~remaining] = -numpy.inf
+        seed = int(first_min(-distances))
+        remaining[seed] = False
+        seeds.append(seed)
+    return seeds
+
+
+def get_centroid_distances(coords, norms, centroids):
+    """
+    Returns an array of the squared Euclidean distance between each
+    point (row of the sparse coords matrix, with squared norms norms)
+    and each (dense) centroid, computed as |x|^2 + |c|^2 - 2x.c.
+    """
+    centroids = numpy.asarray(centroids)
+    distances = coords.dot(centroids.T)
+    distances *= -2
+    distances += norms[:, None]
+    distances += (centroids * centroids).sum(axis=1)[None, :]
+    numpy.maximum(distances, 0, out=distances)
+    return distances
+
+
+def first_min(values):
+    """
+    Returns the index of the minimum value (of each row, for a 2D
+    array). Distances computed from norms and dot products are subject
+    to rounding error, so values within a small tolerance of the
+    minimum count as ties, which go to the first of them, as they do
+    when comparing exact distances.
+    """
+    minimum = values.min(axis=-1)[..., None]
+    ties = values <= minimum + DISTANCE_TOLERANCE * numpy.maximum(
+        1, abs(minimum))
+    return ties.argmax(axis=-1)
+
+
+def kmeans_scipy(points, k, coords, norms, weights, rng=None):
+    """
+    Return Clusters of Points formed by K-means clustering. Each
+    iteration assigns every point to its nearest centroid using one
+    batched distance computation over the sparse matrix of the points'
+    coords (with squared norms norms), and then moves each centroid to
+    the mean of its points, weighted by the array of their weights. As
+    with kmeans_manual, clusters that become empty are dropped. The
+    points are only read, so the same points can be clustered any
+    number of times.
+    """
+    centroids = coords[get_seeds_scipy(coords, norms, k, rng)].toarray()
+    iterations = 0
+    while True:
+        distances = get_centroid_distances(coords, norms, centroids)
+        labels = first_min(distances)
+        converged = True
+        new_centroids = []
+        for i, centroid in enumerate(centroids):
+            members = numpy.flatnonzero(labels == i)
+            if len(members) == 0:
+                print "Dropped empty cluster"
+                continue
+            new_centroid = get_weighted_mean(coords, weights, members)
+            if not numpy.array_equal(new_centroid, centroid):
+                converged = False
+            new_centroids.append(new_centroid)
+        if converged:
+            break
+        centroids = numpy.array(new_centroids)
+        iterations += 1
+    return make_clusters(points, centroids, labels, distances), iterations
+
+
+def minibatch_kmeans(points, k, coords, norms, weights, rng):
+    """
+    Return Clusters of Points formed by mini-batch K-means, used in
+    place of kmeans_scipy for large numbers of points. Each iteration
+    assigns a random batch of the points to their nearest centroids
+    and moves each centroid to the mean of all the points it has been
+    assigned so far, weighted by the array of their weights, stopping
+    once no centroid moves by more than
+    MINIBATCH_TOLERANCE. Every point is then assigned to its nearest
+    centroid, and clusters left empty are dropped. The batches are
+    drawn using the numpy RandomState rng.
+    """
+    num_points = coords.shape[0]
+    centroids = coords[get_seeds_scipy(coords, norms, k, rng)].toarray()
+    counts = numpy.zeros(len(centroids))
+    batch_size = min(MINIBATCH_SIZE, num_points)
+    for iterations in xrange(MINIBATCH_ITERATIONS):
+        batch = rng.choice(num_points, batch_size, replace=False)
+        labels = first_min(get_centroid_distances(coords[batch], norms[batch],
+                                                  centroids))
+        shift = 0
+        for i in numpy.unique(labels):
+            members = batch[labels == i]
+            total = counts[i] + weights[members].sum()
+            centroid = (counts[i] * centroids[i] + 
+                        coords[members].T.dot(weights[members])) / total
+            shift = max(shift, ((centroid - centroids[i]) ** 2).sum())
+            centroids[i] = centroid
+            counts[i] = total
+        if shift <= MINIBATCH_TOLERANCE:
+            break
+    distances = get_centroid_distances(coords, norms, centroids)
+    labels = first_min(distances)
+    for i in range(len(centroids)):
+        if not (labels == i).any():
+            print "Dropped empty cluster"
+    return make_clusters(points, centroids, labels, distances), iterations
+
+
+def get_linkage(distances):
+    """
+    Returns the linkage matrix of Ward agglomerative clustering of
+    points, given the square array of squared distances between them.
+    Ward's method merges the pair of clusters that least increases the
+    total squared distance of points to their centroids, which is what
+    k-means minimises.
+    """
+    return hierarchy.linkage(squareform(numpy.sqrt(distances), checks=False), 
+                             method='ward')
+
+
+def agglomerative(points, k, linkage, coords, norms, weights, 
+                  tree_points=None):
+    """
+    Return Clusters of Points formed by cutting the tree of the linkage
+    into k clusters, with centroids weighted by the array of the
+    points' weights. If the linkage was only built over some of the
+    points, given by the indices tree_points, every point is then
+    assigned to the nearest of the centroids of the clusters cut from
+    the tree, and clusters left empty are dropped.
+    """
+    labels = hierarchy.cut_tree(linkage, n_clusters=k).ravel()
+    if tree_points is None:
+        tree_points = numpy.arange(coords.shape[0])
+        assign = False
+    else:
+        assign = True
+    centroids = numpy.array([get_weighted_mean(coords, weights, 
+                                               tree_points[labels == i])
+                             for i in range(k)])
+    distances = get_centroid_distances(coords, norms, centroids)
+    if assign:
+        labels = first_min(distances)
+    return make_clusters(points, centroids, labels, distances)
+
+
+def get_dendrogram(linkage, num_leaves, weights):
+    """
+    Returns the width and height of an SVG drawing of the top of the
+    tree of the linkage, cut off at num_leaves leaves, along with the
+    points of the line for each merge and the position and number of
+    items of each leaf, given the array of the weights of the points
+    the tree was built over.
+    """
+    tree = hierarchy.dendrogram(linkage, truncate_mode='lastp', p=num_leaves,
+                                no_plot=True)
+    top = max(max(ys) for ys in tree['dcoord']) or 1
+    bottom = DENDROGRAM_HEIGHT - DENDROGRAM_MARGIN
+    # leaves are drawn by dendrogram 10 units apart, starting at 5
+    get_x = lambda x: x / 10 * DENDROGRAM_LEAF_WIDTH
+    get_y = lambda y: bottom - y / top * (bottom - DENDROGRAM_MARGIN)
+    lines = [' '.join('{0:.1f},{1:.1f}'.format(get_x(x), get_y(y)) 
+                      for x, y in zip(xs, ys))
+             for xs, ys in zip(tree['icoord'], tree['dcoord'])]
+    # the weight of each node of the tree, the points followed by the
+    # clusters formed by each merge
+    node_weights = list(weights)
+    for merge in linkage:
+        node_weights.append(node_weights[int(merge[0])] + 
+                            node_weights[int(merge[1])])
+    leaves = [{'x' : get_x(10 * i + 5), 'size' : int(node_weights[node])}
+              for i, node in enumerate(tree['leaves'])]
+    return {
+        'width' : len(leaves) * DENDROGRAM_LEAF_WIDTH,
+        'height' : DENDROGRAM_HEIGHT + 2 * DENDROGRAM_MARGIN,
+        'lines' : lines,
+        'leaves' : leaves,
+        }
+
+
+def make_clusters(points, centroids, labels, distances):
+    """
+    Returns a Cluster of the points assigned to each centroid, given
+    the label of each point and its distances to the centroids.
+    """
+    clusters = []
+    for i, centroid in enumerate(centroids):
+        members = numpy.flatnonzero(labels == i)
+        if len(members) == 0:
+            continue
+        cluster = Cluster([points[j] for j in members], Point(centroid))
+        nearest = members[first_min(distances[members, i])]
+        cluster.nearest_point = points[nearest]
+        clusters.append(cluster)
+    return clusters
+
+
+def kmeans_manual(points, k, rng=None):
     """Return Clusters of Points formed by K-means clustering"""
-    clusters = [Cluster([point]) for point in get_seeds(points, k)]
+    clusters = [Cluster([point]) for point in get_seeds(points, k, rng)]
     iterations = 0
     while True:
         # temp list for each Cluster
@@ -238,27 +557,64 @@ def kmeans(points, k):
     return clusters, iterations
 
 
-def get_points(pdiff, items):
+def get_points(pdiff, parse_cat):
     """
-    For each item: create a attribute vector containing
-    the union of attributes across all the results for that item.
+    For each used item of a parse category: create a attribute vector
+    containing the union of attributes across all the results for that
+    item, taken from the category's ItemMatrix. With scipy, the vectors
+    are sparse, so only the attributes the item has take up space.
+    Items with identical vectors share a single Point, weighted by the
+    number of them, so that the clustering only has to deal with each
+    distinct vector once.
     """ 
-    observations = []
-    num_attributes = len(pdiff.attributes)
-    for item in items:
-        if len(item.results) == 0:
-            continue
-        if SCIPY:
-            attribute_vector = zeros(num_attributes)
-        else:
-            attribute_vector = [0]*num_attributes
-        for i, attribute in enumerate(pdiff.attributes.values()):
-            for result in item.results:
-                if attribute.name in result.attributes:
-                    attribute_vector[i] = attribute.cluster_weight
-                    break
-        observations.append(Point(attribute_vector, item))
-    return observations
+    items = []
+    rows = []
+    for item, row in zip(parse_cat.used_items, parse_cat.used_rows):
+        if len(item.results) != 0:
+            items.append(item)
+            rows.append(row)
+    attributes = pdiff.attributes
+    if SCIPY:
+        coords = parse_cat.matrix.weighted_matrix(rows, attributes.ids, 
+                                                  attributes.cluster_weight)
+        coords.sort_indices()
+        # the value of each attribute is the same for every item that
+        # has it, so the attributes alone identify a vector
+        keys = [tuple(coords.indices[coords.indptr[i]:coords.indptr[i+1]])
+                for i in range(len(rows))]
+        get_vector = coords.getrow
+    else:
+        vectors = parse_cat.matrix.weighted_rows(rows, attributes.ids, 
+                                                 attributes.cluster_weight)
+        keys = [tuple(vector) for vector in vectors]
+        get_vector = lambda i: vectors[i]
+    first_rows = {}
+    members = []
+    for i, key in enumerate(keys):
+        if key not in first_rows:
+            first_rows[key] = len(members)
+            members.append([])
+        members[first_rows[key]].append(i)
+    points = [Point(get_vector(indices[0]), 
+                    members=[(items[i], rows[i]) for i in indices])
+              for indices in members]
+    for i, point in enumerate(points):
+        point.index = i
+    return points
+
+
+def expand_points(points):
+    """
+    Returns a Point for each of the items that the Points stand for,
+    with the same coords and silhouette.
+    """
+    expanded = []
+    for point in points:
+        for item, row in point.members:
+            member = Point(point.coords, item, row)
+            member.silhouette = point.silhouette
+            expanded.append(member)
+    return expanded
 
 
 def get_pair_dist(distances, id1, id2):
@@ -268,15 +624,105 @@ def get_pair_dist(distances, id1, id2):
         return distances[(id2, id1)]
 
 
-def get_silhouette(clusters, distances):
+def get_silhouette_scipy(clusters, distances):
+    """
+    Calculate and save the silhouettue width of each point and cluster
+    and return the average silhouette width of all items, using the
+    square array of distances between the points. Each point counts as
+    many times as its weight. The total distance from each point to the
+    items of each cluster is found with a single matrix product with
+    the clusters' membership masks, scaled by the weights.
+    """
+    points = [p for c in clusters for p in c.points]
+    indices = numpy.array([p.index for p in points])
+    weights = numpy.array([p.weight for p in points], dtype=float)
+    labels = numpy.repeat(numpy.arange(len(clusters)), 
+                          [len(c) for c in clusters])
+    sizes = numpy.bincount(labels, weights, minlength=len(clusters))
+    membership = numpy.zeros((len(indices), len(clusters)))
+    membership[numpy.arange(len(indices)), labels] = weights
+    totals = distances[numpy.ix_(indices, indices)].dot(membership)
+
+    own = numpy.arange(len(indices)), labels
+    a = totals[own] / numpy.maximum(sizes[labels] - 1, 1)
+    means = totals / sizes
+    means[own] = numpy.inf
+    b = means.min(axis=1)
+    widths = numpy.maximum(a, b)
+    singles = (sizes[labels] == 1) | (widths == 0) | numpy.isinf(b)
+    silhouettes = numpy.where(singles, 0, 
+                              (b - a) / numpy.where(singles, 1, widths))
+
+    for point, silhouette in zip(points, silhouettes.tolist()):
+        point.silhouette = silhouette
+    return save_cluster_silhouettes(clusters)
+
+
+def get_sampled_silhouette(clusters, coords, norms, weights, sample):
+    """
+    Estimate the silhouette width of each point and cluster, saving
+    them, and return the average silhouette width of all items, as
+    get_silhouette_scipy does but using only the distances from each
+    point to a sample of the points (given by their indices), so that
+    no more than a chunk of points by the sample size of distances are
+    held at once. The points are weighted by the array weights.
+    """
+    num_points = coords.shape[0]
+    labels = numpy.empty(num_points, dtype=int)
+    points = [None] * num_points
+    for i, cluster in enumerate(clusters):
+        for point in cluster.points:
+            labels[point.index] = i
+            points[point.index] = point
+    sample_labels = labels[sample]
+    sample_sizes = numpy.bincount(sample_labels, weights[sample], 
+                                  minlength=len(clusters))
+    membership = numpy.zeros((len(sample), len(clusters)))
+    membership[numpy.arange(len(sample)), sample_labels] = weights[sample]
+    sample_coords = coords[sample]
+    sample_norms = norms[sample]
+    positions = -numpy.ones(num_points, dtype=int)
+    positions[sample] = numpy.arange(len(sample))
+
+    silhouettes = numpy.empty(num_points)
+    for start in xrange(0, num_points, SILHOUETTE_CHUNK):
+        chunk = numpy.arange(start, min(start + SILHOUETTE_CHUNK, num_points))
+        rows = numpy.arange(len(chunk))
+        distances = (norms[chunk, None] + sample_norms[None, :] - 
+                     2 * (coords[chunk] * sample_coords.T).toarray())
+        numpy.maximum(distances, 0, out=distances)
+        in_sample = positions[chunk] >= 0
+        distances[rows[in_sample], positions[chunk][in_sample]] = 0
+        totals = distances.dot(membership)
+
+        own = rows, labels[chunk]
+        own_sizes = sample_sizes[labels[chunk]] - in_sample
+        a = totals[own] / numpy.maximum(own_sizes, 1)
+        means = totals / numpy.maximum(sample_sizes, 1)
+        means[:, sample_sizes == 0] = numpy.inf
+        means[own] = numpy.inf
+        b = means.min(axis=1)
+        widths = numpy.maximum(a, b)
+        singles = (own_sizes == 0) | (widths == 0) | numpy.isinf(b)
+        silhouettes[chunk] = numpy.where(singles, 0, (b - a) / 
+                                         numpy.where(singles, 1, widths))
+
+    for point, silhouette in zip(points, silhouettes.tolist()):
+        point.silhouette = silhouette
+    return save_cluster_silhouettes(clusters)
+
+
+def get_silhouette_manual(clusters, distances):
     """
     Calculate and save the silhouettue width of each cluster and returns
-    the average silhouette width of all clusters
+    the average silhouette width of all items, each point counting as
+    many times as its weight
     """
     for cluster in clusters:
-        len_c = len(cluster)
+        len_c = sum(p.weight for p in cluster.points)
         for point in cluster.points:
-            point_atot = sum(get_pair_dist(distances, point.id, p.id) 
+            # the other items of the point are at a distance of 0
+            point_atot = sum(p.weight * get_pair_dist(distances, point.id, p.id) 
                              for p in cluster.points if p is not point)
             if len_c != 1:
                 a = point_atot / (len_c - 1)
@@ -284,56 +730,280 @@ def get_silhouette(clusters, distances):
                 for other_c in clusters:
                     if other_c is cluster:
                         continue
-                    point_btot = sum(get_pair_dist(distances, point.id, p.id) 
+                    point_btot = sum(p.weight * 
+                                     get_pair_dist(distances, point.id, p.id) 
                                      for p in other_c.points)
-                    bs.append(point_btot / len(other_c))
+                    bs.append(point_btot / 
+                              sum(p.weight for p in other_c.points))
                 b = min(bs)
                 point.silhouette = (b - a) / max(a, b)
             else:
                 point.silhouette = 0
-        cluster.silhouette = sum(p.silhouette for p in cluster.points) / len_c
-    all_sils = [p.silhouette for p in 
-                itertools.chain(*(c.points for c in clusters))]
-    return sum(all_sils) / len(all_sils)
-
-
-def do_clustering(pdiff, parse_cat):
-    k = pdiff.gopts.k
-    points = get_points(pdiff, parse_cat.used_items)
-    len_points = len(points)
-    if len_points <= 1:
-        return None
-    if pdiff.gopts.debug:
-        msg = "Clustering {0} items from {1}"
-        print msg.format(parse_cat.num_used_items, parse_cat.title)
-    if len_points <= k:
-        if len_points == 2:
-            k = 2
+    return save_cluster_silhouettes(clusters)
+
+
+def save_cluster_silhouettes(clusters):
+    """
+    Saves the silhouette width of each cluster, the average of those of
+    its items, and returns the average of all the items.
+    """
+    total = 0
+    num_items = 0
+    for cluster in clusters:
+        cluster_total = sum(p.weight * p.silhouette for p in cluster.points)
+        cluster_items = sum(p.weight for p in cluster.points)
+        cluster.silhouette = cluster_total / cluster_items
+        total += cluster_total
+        num_items += cluster_items
+    return total / num_items
+
+
+if SCIPY:
+    get_silhouette = get_silhouette_scipy
+else:
+    get_silhouette = get_silhouette_manual
+
+
+class ClusterJob:
+    """
+    The clustering of a parse category. Holds the Points of its items,
+    along with their coords matrix and distances (or the sample used
+    to estimate silhouettes) and the tree of agglomerative clustering,
+    which each run of k-means or cut of the tree only reads, so that
+    runs for every k and restart can share them, including worker
+    processes forked once the ClusterJobs have been made.
+    """
+    def __init__(self, pdiff, parse_cat):
+        gopts = pdiff.gopts
+        self.title = parse_cat.title
+        self.matrix = parse_cat.matrix
+        self.debug = gopts.debug
+        self.points = get_points(pdiff, parse_cat)
+        self.k = gopts.k
+        self.ks = []
+        self.method = gopts.cluster_method
+        self.linkage = None
+        len_points = len(self.points)
+        if len_points <= 1:
+            return
+        if self.debug:
+            msg = "Clustering {0} items from {1}, as {2} distinct points"
+            print msg.format(parse_cat.num_used_items, self.title, len_points)
+        self.limit_k(len_points)
+
+        if SCIPY:
+            self.coords = get_coords_matrix(self.points)
+            self.norms = get_squared_norms(self.coords)
+            self.weights = numpy.array([p.weight for p in self.points], 
+                                       dtype=float)
+        self.sampled = SCIPY and len_points > gopts.sample_size
+        if self.sampled:
+            # too many points for the full array of distances between them
+            if self.debug:
+                print "Sampling {0} items...".format(gopts.sample_size)
+            rng = numpy.random.RandomState(SAMPLE_SEED)
+            self.sample = numpy.sort(rng.choice(len_points, gopts.sample_size, 
+                                                replace=False))
+            # the seed of each run is drawn from the same RandomState,
+            # so the results don't depend on the global random seed
+            self.draw_seed = lambda: rng.randint(2**31)
         else:
-            k = len_points - 1
-        if pdiff.gopts.debug:
-            print "Max k changed to {0}".format(k)
-    if pdiff.gopts.debug:
-        print "Calculating distances between points..."
-    dists = get_all_distances(points)
-    if pdiff.gopts.forcek:
-        # just do clustering for k
-        clusters, iterations = kmeans(points, k)
-        sil = get_silhouette(clusters, dists)
-    else:
-        # select best number of cluster from up to k
+            if self.debug:
+                print "Calculating distances between points..."
+            if SCIPY:
+                self.dists = get_pairwise_distances(self.coords, self.norms)
+            else:
+                self.dists = get_all_distances(self.points)
+            self.draw_seed = lambda: random.randrange(2**31)
+
+        if self.method == 'agglomerative':
+            # one tree is built, over the sample if there is one, and
+            # then cut into each number of clusters
+            if self.debug:
+                print "Building tree..."
+            if self.sampled:
+                # the tree can't be cut into more clusters than the
+                # sample has points
+                self.limit_k(len(self.sample))
+                self.linkage = get_linkage(get_pairwise_distances(
+                        self.coords[self.sample], self.norms[self.sample]))
+            else:
+                self.linkage = get_linkage(self.dists)
+
+        if gopts.forcek:
+            # just do clustering for k
+            self.ks = [self.k]
+        else:
+            # select best number of cluster from up to k
+            self.ks = range(2, self.k + 1)
+
+    def limit_k(self, num_points):
+        """Lowers k if it isn't less than the number of points."""
+        if num_points <= self.k:
+            if num_points == 2:
+                self.k = 2
+            else:
+                self.k = num_points - 1
+            if self.debug:
+                print "Max k changed to {0}".format(self.k)
+
+    def get_tasks(self, restarts):
+        """
+        Returns the k and random seed of each run of k-means to be
+        done, restarts of them for each k. Cutting the tree of
+        agglomerative clustering needs neither seeds nor restarts.
+        """
+        if self.method == 'agglomerative':
+            return [(k, None) for k in self.ks]
+        return [(k, self.draw_seed()) for k in self.ks 
+                for restart in range(restarts)]
+
+    def run(self, k, seed):
+        """
+        Clusters the points into k clusters, seeding k-means with a
+        random number generator made from seed, and returns the
+        silhouette, number of iterations and the packed clusters. With
+        agglomerative clustering, the tree is cut into k clusters
+        instead.
+        """
+        if self.method == 'agglomerative':
+            tree_points = self.sample if self.sampled else None
+            clusters = agglomerative(self.points, k, self.linkage, self.coords,
+                                     self.norms, self.weights, tree_points)
+            if self.sampled:
+                sil = get_sampled_silhouette(clusters, self.coords, self.norms,
+                                             self.weights, self.sample)
+            else:
+                sil = get_silhouette(clusters, self.dists)
+            return sil, 0, pack_clusters(clusters)
+        if SCIPY:
+            rng = numpy.random.RandomState(seed)
+        else:
+            rng = random.Random(seed)
+        if self.sampled:
+            clusters, iterations = minibatch_kmeans(self.points, k, self.coords,
+                                                    self.norms, self.weights, 
+                                                    rng)
+            sil = get_sampled_silhouette(clusters, self.coords, self.norms,
+                                         self.weights, self.sample)
+        elif SCIPY:
+            clusters, iterations = kmeans_scipy(self.points, k, self.coords, 
+                                                self.norms, self.weights, rng)
+            sil = get_silhouette(clusters, self.dists)
+        else:
+            clusters, iterations = kmeans_manual(self.points, k, rng)
+            sil = get_silhouette(clusters, self.dists)
+        return sil, iterations, pack_clusters(clusters)
+
+    def get_results(self, runs):
+        """
+        Given the (k, seed) of each task and the result of its run,
+        keeps the best restart for each k and returns the Results of
+        the k with the best silhouette.
+        """
+        if not self.ks:
+            return None
+        best = {}
+        for (k, seed), (sil, iterations, packed) in runs:
+            if k not in best or sil > best[k][0]:
+                best[k] = sil, iterations, packed
         sil = -2
-        for this_k in range(2, k + 1):
-            this_cls, iterations = kmeans(copy.deepcopy(points), this_k)
-            this_sil = get_silhouette(this_cls, dists)
+        for this_k in self.ks:
+            this_sil, iterations, packed = best[this_k]
             if this_sil > sil:
                 sil = this_sil
-                clusters = this_cls
+                chosen = packed
                 chosen_k = this_k
-            if pdiff.gopts.debug:
+            if self.debug:
                 msg = "k = {0}, silhouette of {1:.3f}, with {2} iteration(s)"
                 print msg.format(this_k, this_sil, iterations)
-    if pdiff.gopts.debug:
-        print "Best k = {0}".format(chosen_k)
-        print "Found {0} clusters\n".format(len(clusters))
-    return Results(sil, clusters)
+        clusters = unpack_clusters(self.points, chosen)
+        if self.debug:
+            print "Best k = {0} for {1}".format(chosen_k, self.title)
+            print "Found {0} clusters\n".format(len(clusters))
+        if self.linkage is None:
+            results = Results(sil, clusters)
+        else:
+            if self.sampled:
+                tree_weights = self.weights[self.sample]
+            else:
+                tree_weights = self.weights
+            dendrogram = get_dendrogram(self.linkage, self.k, tree_weights)
+            results = Results(sil, clusters, dendrogram)
+        results.count_attributes(self.matrix)
+        return results
+
+
+def pack_clusters(clusters):
+    """
+    Returns the clusters in a form that is cheap to send back from a
+    worker process, referring to points by their index rather than
+    including their items.
+    """
+    return [([p.index for p in cluster.points], cluster.centroid.coords,
+             cluster.nearest_point.index, 
+             [p.silhouette for p in cluster.points], cluster.silhouette)
+            for cluster in clusters]
+
+
+def unpack_clusters(points, packed):
+    """
+    The reverse of pack_clusters, given the points clustered, except
+    that each Cluster has a Point for every item of its points, as
+    the view of the clusters lists every item.
+    """
+    clusters = []
+    for indices, centroid, nearest, silhouettes, silhouette in packed:
+        cluster_points = [points[i] for i in indices]
+        for point, point_silhouette in zip(cluster_points, silhouettes):
+            point.silhouette = point_silhouette
+        cluster = Cluster(expand_points(cluster_points), Point(centroid))
+        nearest_item = points[nearest].item
+        cluster.nearest_point = next(p for p in cluster.points 
+                                     if p.item is nearest_item)
+        cluster.silhouette = silhouette
+        clusters.append(cluster)
+    return clusters
+
+
+def do_clustering(pdiff, parse_cats):
+    """
+    Clusters each of the parse categories, returning their Results, or
+    None for those with too few items. Every k for every category is
+    run gopts.restarts times, and with more than one job, the runs are
+    shared out between a pool of worker processes.
+    """
+    gopts = pdiff.gopts
+    cluster_jobs = [ClusterJob(pdiff, parse_cat) for parse_cat in parse_cats]
+    tasks = [(i, task) for i, cluster_job in enumerate(cluster_jobs) 
+             for task in cluster_job.get_tasks(gopts.restarts)]
+    jobs = min(gopts.jobs, len(tasks))
+    if jobs <= 1:
+        runs = [cluster_jobs[i].run(*task) for i, task in tasks]
+    else:
+        # workers are forked, so the points and distances are inherited
+        # rather than being pickled for every task
+        pool = multiprocessing.Pool(jobs, init_worker, (cluster_jobs,))
+        try:
+            runs = pool.map(cluster_worker, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    job_runs = [[] for cluster_job in cluster_jobs]
+    for (i, task), run in zip(tasks, runs):
+        job_runs[i].append((task, run))
+    return [cluster_job.get_results(this_runs) 
+            for cluster_job, this_runs in zip(cluster_jobs, job_runs)]
+
+
+worker_jobs = None
+
+
+def init_worker(cluster_jobs):
+    global worker_jobs
+    worker_jobs = cluster_jobs
+
+
+def cluster_worker(task):
+    i, (k, seed) = task
+    return worker_jobs[i].run(k, seed)
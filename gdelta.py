@@ -35,7 +35,7 @@ A program to expose information about the impact that changes made to
 a DELPH-IN grammar has had on parser output between runs over selected
 profiles.
 
-Usage: gdelta.py [options] grammar_name grammarA grammarB profile
+Usage: gdelta.py [options] grammar_name grammarA grammarB [grammarC ...] profile
 
 Where 'grammar_name' is the name that TSDB uses to refer to the
 grammar (eg 'erg' or 'gg'), 'grammarA' and 'grammarB' are the labels
@@ -49,6 +49,12 @@ details.
 Grammars A and B are expected to be complete DELPH-IN grammars where B
 is a copy of A but with at least some changes made.
 
+More than one new grammar may be given, eg successive revisions of
+grammar A. Grammar A and its profiles are then loaded and processed
+just once, each new grammar is compared against it (in parallel, when
+using more than one job), and a report is written for each pair along
+with a summary page comparing all of the new grammars.
+
 The default behaviour is to write output files to the directory
 'gdelta_out/' but this can be changed with the --outdir option.
 
@@ -79,9 +85,101 @@ Options:
       frequency, and 'count' uses the change in frequency of
       attributes. Default is delta_idf.
       
+ --cluster-method=method
+      Specifies how the items of each parse change category are
+      clustered. Valid methods are 'kmeans' and 'agglomerative'.
+      kmeans runs k-means clustering once for each value of k (or
+      more, with --restarts). agglomerative builds a single tree by
+      repeatedly merging the pair of clusters that are closest by
+      Ward's criterion, and cuts it into each number of clusters,
+      which also gives a drawing of the top of the tree on the
+      clusters page. For categories with more than --sample items,
+      the tree is built over the sample, and every item is then put
+      in the cluster with the nearest centre. The agglomerative
+      method requires SciPy. Default is kmeans.
+
+ -t N, --top-attributes=N
+      Specifies the number of the exemplar's attributes (those with
+      the highest weighting) shown for each cluster, along with their
+      cohesion and overlap. Default is N = 5.
+
+ -r N, --restarts=N
+      Run k-means N times for each value of k, each time from a
+      different random seed, keeping the run with the best
+      silhouette. More restarts make the clustering, and the value of
+      k chosen, less dependent on the seeds. Default is N = 1.
+
+ -j N, --jobs=N
+      Read the grammars' TDL files, load and process the profiles and
+      run the clustering using N worker processes. Each run of k-means
+      for each value of k and each parse change category can be done
+      by a different worker. Useful for large grammars, for virtual
+      profiles with many members and for large categories. Default is
+      N = 1.
+
  --outdir=dir
       Specifies an alternate path to put output files.
 
+ --items=ids
+      Only compare the items with these IDs, given as a comma
+      separated list of IDs and ranges of IDs, eg 1,5,10-20. Rather
+      than scanning every table, gDelta seeks directly to the rows for
+      these items using an index of byte offsets. If a --cache-dir is
+      given, the index is stored there when it is first built and
+      reused by later runs; otherwise it is built again by each run.
+
+ --cache-dir=dir
+      Keep snapshots of processed profiles in this directory. A
+      profile whose tables, grammar lexicon and relevant options
+      haven't changed since it was cached is loaded from its snapshot
+      rather than being processed again. The types and lexical entries
+      read from each TDL file are also kept here, so only files that
+      have changed are read again.
+
+ --lazy-lexicon
+      Rather than loading the grammars' lexicons into memory, index
+      each lexicon file in the --cache-dir (which must be given) and
+      only look up the lexical entries that occur in the results. An
+      index is built the first time a version of a lexicon file is
+      seen.
+
+ --stream
+      Process one profile at a time, keeping running totals rather
+      than every item of every profile in memory. Only the items
+      in the parse change categories (and only then when clustering)
+      and items with errors are kept; the details needed for the
+      items page are written to a temporary file. Useful for very
+      large virtual profiles.
+
+ --sample=N
+      Parse change categories with more than N items are clustered
+      with mini-batch k-means, and the silhouettes used to choose k
+      are estimated from a random sample of N items, rather than
+      computing the distances between every pair of items. The
+      sample and batches are drawn with a fixed seed, so results are
+      reproducible. Requires SciPy. Default is N = 2000.
+
+ --map=I/N
+      Split the comparison into N shards, to be run as separate
+      processes or on separate machines, and run the I-th of them. The
+      shard processes every N-th member of the virtual profile,
+      starting with the I-th, and writes a partial result file to the
+      output directory rather than a report.
+
+ --reduce=dir
+      Merge the partial results of every shard of the comparison,
+      found in this directory, and write the report. The profiles
+      themselves don't need to be available.
+
+ --watch
+      Keep running after writing the report, watching grammar B's TDL
+      files and its results for the profiles. Whenever they change,
+      only what has changed is reloaded (the grammar, and then every
+      profile if its lexicon has changed, or just the profiles with
+      new results) and the report is written again. Grammar A and its
+      profiles are kept in memory. Only one new grammar may be given.
+      Stop with Ctrl-C.
+
  --no-clustering
       Skip the clustering and don't produce any corresponding output.
 
@@ -116,18 +214,23 @@ Options:
 
 import sys
 import os
+import time
 import getopt
+import multiprocessing
 
-from pdiff import Pdiff
-from output import Output 
+from pdiff import Pdiff, LoadedProfiles, WorkerExit
+from output import Output, Revision, RevisionsOutput
 
 import logon
 import profile
 import cluster
+import partial
+import cache
 
 
 class Usage(Exception):
-    usage = "Usage: gdelta.py [options] grammar_name grammarA grammarB profile"
+    usage = "Usage: gdelta.py [options] grammar_name grammarA grammarB " \
+        "[grammarC ...] profile"
     help = "For help use -h or --help"
 
     def __init__(self, msg):
@@ -145,6 +248,10 @@ class Opts():
     virtual_path = os.path.join(tsdb_path, 'virtual') 
     nbest = 1
     k = 6
+    restarts = 1
+    cluster_method = 'kmeans'
+    top_attributes = 5
+    jobs = 1
     clustering = True
     use_errors = True
     forcek =  False
@@ -153,6 +260,28 @@ class Opts():
     gold = False
     weighting = 'delta_idf'
     out_dir =  'gdelta_out'
+    cache_dir = None
+    item_ids = None
+    lazy_lexicon = False
+    stream = False
+    watch = False
+    shard = None
+    sample_size = 2000
+    partial_dir = None
+
+
+def parse_item_ids(arg):
+    """Returns the set of item IDs in a string like '1,5,10-20'."""
+    item_ids = set()
+    for part in arg.split(','):
+        bounds = part.split('-')
+        if len(bounds) > 2 or not all(b.isdigit() for b in bounds):
+            raise Usage('Items option requires a list of IDs and ranges')
+        start, end = int(bounds[0]), int(bounds[-1])
+        if start > end:
+            raise Usage('Items option ranges must be given as low-high')
+        item_ids.update(range(start, end + 1))
+    return item_ids
 
 
 def main(argv=None):
@@ -160,9 +289,13 @@ def main(argv=None):
         argv = sys.argv
     try:
         try:
-            short_opts = 'b:k:w:r:o:h'
+            short_opts = 'b:k:w:r:t:o:j:h'
             long_opts = ['best=','k=', 'help', 'weight=', 'forcek', 'debug', 
-                         'outdir=', 'no-clustering', 'skip-errors', 'ask', 'gold']
+                         'outdir=', 'no-clustering', 'skip-errors', 'ask', 'gold',
+                         'jobs=', 'cache-dir=', 'items=', 'lazy-lexicon',
+                         'stream', 'watch', 'map=', 'reduce=', 
+                         'sample=', 'restarts=',
+                         'cluster-method=', 'top-attributes=']
             opts, args = getopt.getopt(argv[1:], short_opts, long_opts)
         except getopt.error, err:
             raise Usage(err.msg)
@@ -180,6 +313,26 @@ def main(argv=None):
                 if not arg.isdigit():
                     raise Usage('K option requires an integer argument')
                 gopts.k = int(arg)
+            elif opt == '--cluster-method':
+                if arg not in ('kmeans', 'agglomerative'):
+                    msg = 'Cluster method argument must be one of "kmeans" ' \
+                        'or "agglomerative"'
+                    raise Usage(msg)
+                gopts.cluster_method = arg
+            elif opt in ('-t', '--top-attributes'):
+                if not arg.isdigit() or int(arg) == 0:
+                    raise Usage('Top attributes option requires a positive '
+                                'integer argument')
+                gopts.top_attributes = int(arg)
+            elif opt in ('-r', '--restarts'):
+                if not arg.isdigit() or int(arg) == 0:
+                    raise Usage('Restarts option requires a positive integer '
+                                'argument')
+                gopts.restarts = int(arg)
+            elif opt in ('-j', '--jobs'):
+                if not arg.isdigit() or int(arg) == 0:
+                    raise Usage('Jobs option requires a positive integer argument')
+                gopts.jobs = int(arg)
             elif opt in ('-w', '--weight'):
                 if arg not in ('delta_idf', 'delta_idf2', 'count'):
                     msg = 'Weight argument must be one of "delta_idf", ' \
@@ -188,6 +341,28 @@ def main(argv=None):
                 gopts.weighting = arg
             elif opt in('o', '--outdir'):
                 gopts.outdir = arg
+            elif opt == '--items':
+                gopts.item_ids = parse_item_ids(arg)
+            elif opt == '--sample':
+                if not arg.isdigit() or int(arg) < 2:
+                    raise Usage('Sample option requires an integer argument '
+                                'of at least 2')
+                gopts.sample_size = int(arg)
+            elif opt == '--map':
+                gopts.shard = partial.parse_shard(arg)
+                if gopts.shard is None:
+                    raise Usage('Map option requires an argument of the form '
+                                'I/N, where 1 <= I <= N')
+            elif opt == '--reduce':
+                gopts.partial_dir = arg
+            elif opt == '--watch':
+                gopts.watch = True
+            elif opt == '--stream':
+                gopts.stream = True
+            elif opt == '--lazy-lexicon':
+                gopts.lazy_lexicon = True
+            elif opt == '--cache-dir':
+                gopts.cache_dir = arg
             elif opt in ('-g', '--gold'):
                 gopts.gold = True
             elif opt == '--no-clustering':
@@ -201,11 +376,26 @@ def main(argv=None):
             elif opt == '--ask':
                 gopts.ask_profile = True
 
-        len_args = len(args) 
-        if len_args > 4:
-            raise Usage("Too many arguments.")
-        elif len_args < 4:
+        if gopts.lazy_lexicon and gopts.cache_dir is None:
+            raise Usage("The --lazy-lexicon option requires --cache-dir.")
+        if gopts.cluster_method == 'agglomerative' and not cluster.SCIPY:
+            raise Usage("The agglomerative cluster method requires SciPy.")
+        if gopts.ask_profile and gopts.watch:
+            raise Usage("The --ask option cannot be used with --watch.")
+        if gopts.ask_profile and gopts.jobs > 1:
+            raise Usage("The --ask option cannot be used with --jobs.")
+
+        if len(args) < 4:
             raise Usage("Not enough arguments.")
+        for opt, used in (('--watch', gopts.watch), 
+                          ('--map', gopts.shard is not None),
+                          ('--reduce', gopts.partial_dir is not None)):
+            if used and len(args) > 4:
+                msg = "The {0} option can only be used with one new grammar."
+                raise Usage(msg.format(opt))
+        if gopts.shard is not None and gopts.partial_dir is not None:
+            raise Usage("The --map and --reduce options cannot be used "
+                        "together.")
    
     except Usage, err:
         print >>sys.stderr, err
@@ -213,38 +403,235 @@ def main(argv=None):
 
     gram_name = args[0]
     prev_alias = args[1]
-    new_alias = args[2]
-    profile_alias = args[3]
+    new_aliases = args[2:-1]
+    profile_alias = args[-1]
     grammars = logon.find_grammars(gopts.logonroot)
 
     try:
         prev_gram = grammars[prev_alias]
-        new_gram = grammars[new_alias]
+        new_grams = [grammars[alias] for alias in new_aliases]
     except KeyError, err:
         msg = "Grammar {0} was not found in registry file."
         print >>sys.stderr, msg.format(err)
         print >>sys.stderr, "For help use -h or --help"
         return 2       
 
-    prev_gram.name = new_gram.name = gram_name 
+    prev_gram.name = gram_name 
+    for new_gram in new_grams:
+        new_gram.name = gram_name
     if profile_alias.startswith('vm') or profile_alias.startswith('ec'):
         speech = True
     else:
         speech = False
 
-    prev_gram.load(speech)
-    new_gram.load(speech)
+    if gopts.cache_dir is not None and not os.path.isdir(gopts.cache_dir):
+        os.makedirs(gopts.cache_dir)
+
+    logon.load_grammars([prev_gram] + new_grams, speech, gopts.cache_dir, 
+                        gopts.jobs, gopts.lazy_lexicon)
+    if gopts.partial_dir is not None:
+        try:
+            profile_names, prev_profiles, new_profiles = partial.read_partials(
+                gopts.partial_dir, prev_gram, new_grams[0], profile_alias, 
+                gopts)
+        except partial.PartialError, err:
+            print >>sys.stderr, err.msg
+            return 2
+        compare(prev_gram, new_grams[0], profile_alias, profile_names, gopts,
+                prev_profiles, new_profiles)
+        return 0
+
     profile_names = logon.get_profile_names(gopts.virtual_path, profile_alias)
-    pdiff = Pdiff(prev_gram, new_gram, profile_alias, profile_names, gopts)
+    if gopts.shard is not None:
+        shard, num_shards = gopts.shard
+        partial.write_partial(prev_gram, new_grams[0], profile_alias, 
+                              profile_names, shard, num_shards, gopts)
+        return 0
+    if gopts.watch:
+        watcher = Watcher(prev_gram, new_grams[0], profile_alias, 
+                          profile_names, speech, gopts)
+        watcher.run()
+        return 0
+    if len(new_grams) == 1:
+        compare(prev_gram, new_grams[0], profile_alias, profile_names, gopts)
+        return 0
+
+    baseline = LoadedProfiles(prev_gram, profile_names, gopts, 
+                              keep_derivations=True)
+    revisions = compare_revisions(baseline, new_grams, profile_alias, 
+                                  profile_names, gopts)
+    profile.DERIVATIONS.release()
+    output = RevisionsOutput(gram_name, prev_gram, profile_alias, 
+                             profile_names, revisions, gopts)
+    output.do_output()
+    return 0
+
+
+def compare(prev_gram, new_gram, profile_alias, profile_names, gopts, 
+            prev_profiles=None, new_profiles=None):
+    """
+    Compares the results of two grammars over the profiles, writes the
+    report and returns the Revision for the new grammar.
+    """
+    pdiff = Pdiff(prev_gram, new_gram, profile_alias, profile_names, gopts,
+                  prev_profiles, new_profiles)
     
     if gopts.clustering:
-        for parse_cat in pdiff.parse_cats:
-            parse_cat.results = cluster.do_clustering(pdiff, parse_cat)
+        results = cluster.do_clustering(pdiff, pdiff.parse_cats)
+        for parse_cat, parse_results in zip(pdiff.parse_cats, results):
+            parse_cat.results = parse_results
 
     output = Output(pdiff, gopts)
     output.do_output()
+    return Revision(pdiff, output.views[0].files['html'])
+
+
+def compare_revisions(baseline, new_grams, profile_alias, profile_names, 
+                      gopts):
+    """
+    Compares each of the new grammars against the baseline, returning
+    their Revisions. With more than one job, each new grammar is
+    compared by its own worker process, which inherits the baseline.
+    """
+    jobs = min(gopts.jobs, len(new_grams))
+    if jobs <= 1:
+        return [compare(baseline.grammar, new_gram, profile_alias, 
+                        profile_names, gopts, baseline) 
+                for new_gram in new_grams]
+
+    initargs = (baseline, new_grams, profile_alias, profile_names, gopts)
+    pool = multiprocessing.Pool(jobs, init_revision_worker, initargs)
+    try:
+        return pool.map(compare_revision_worker, range(len(new_grams)))
+    except WorkerExit as err:
+        pool.terminate()
+        sys.exit(err.code)
+    finally:
+        pool.close()
+        pool.join()
 
-    return 0
+
+revision_args = None
+
+
+def init_revision_worker(*args):
+    global revision_args
+    revision_args = args
+
+
+def compare_revision_worker(index):
+    baseline, new_grams, profile_alias, profile_names, gopts = revision_args
+    # the worker is itself a member of a pool, so can't have one of its own
+    gopts.jobs = 1
+    try:
+        return compare(baseline.grammar, new_grams[index], profile_alias,
+                       profile_names, gopts, baseline)
+    except SystemExit as err:
+        raise WorkerExit(err.code)
+
+
+class Watcher:
+    """
+    Keeps the previous grammar and both grammars' processed profiles in
+    memory, and writes the report again whenever the new grammar's TDL
+    files or profile results change, only reloading what has changed.
+    """
+    interval = 2
+
+    def __init__(self, prev_gram, new_gram, profile_alias, profile_names, 
+                 speech, gopts):
+        self.prev_gram = prev_gram
+        self.new_gram = new_gram
+        self.profile_alias = profile_alias
+        self.profile_names = profile_names
+        self.speech = speech
+        self.gopts = gopts
+        self.prev_profiles = LoadedProfiles(prev_gram, profile_names, gopts,
+                                            keep_derivations=True)
+        self.new_profiles = LoadedProfiles(new_gram, profile_names, gopts)
+        # reloaded profiles only make use of recently scanned derivations
+        profile.DERIVATIONS.release()
+        self.grammar_state = self.get_grammar_state()
+        self.profile_states = self.get_profile_states()
+
+    def run(self):
+        self.compare()
+        try:
+            while True:
+                time.sleep(self.interval)
+                self.update()
+        except KeyboardInterrupt:
+            pass
+
+    def compare(self):
+        compare(self.prev_gram, self.new_gram, self.profile_alias, 
+                self.profile_names, self.gopts, self.prev_profiles, 
+                self.new_profiles)
+        print "Report written at {0}".format(time.strftime('%H:%M:%S'))
+
+    def update(self):
+        """
+        Reloads the new grammar if any of its TDL files have changed
+        and any of its profiles whose results have changed, and writes
+        the report again if anything did.
+        """
+        changed_names = []
+        grammar_changed = self.get_grammar_state() != self.grammar_state
+        if grammar_changed:
+            fingerprint = self.new_gram.lexicon_fingerprint
+            logon.load_grammars([self.new_gram], self.speech, 
+                                self.gopts.cache_dir, self.gopts.jobs, 
+                                self.gopts.lazy_lexicon)
+            self.grammar_state = self.get_grammar_state()
+            if self.new_gram.lexicon_fingerprint != fingerprint:
+                # the lexical types found in every profile may differ
+                changed_names = self.profile_names
+
+        profile_states = self.get_profile_states()
+        if not changed_names:
+            changed_names = [name for name in self.profile_names 
+                             if profile_states[name] != 
+                             self.profile_states[name]]
+        if changed_names:
+            self.new_profiles.load(changed_names)
+        self.profile_states = profile_states
+
+        if grammar_changed or changed_names:
+            self.compare()
+
+    def get_grammar_state(self):
+        """The modification time and size of each of the TDL files."""
+        paths = [self.new_gram.tdl_path]
+        paths.extend(os.path.join(self.new_gram.path, f) for f in 
+                     self.new_gram.tdl_files + self.new_gram.lex_files)
+        return get_file_states(paths)
+
+    def get_profile_states(self):
+        """
+        The path of the results of each profile, which changes when
+        there is a newer run, and the state of the TSDB tables that are
+        read from there. Other files in the directory, such as those
+        written by other tools, are ignored.
+        """
+        states = {}
+        for profile_name in self.profile_names:
+            path = profile.find_profile_path(profile_name, self.new_gram, 
+                                             self.gopts)
+            files = [os.path.join(path, table) + ext 
+                     for table in cache.TABLES for ext in ('', '.gz')]
+            states[profile_name] = (path, get_file_states(files))
+        return states
+
+
+def get_file_states(paths):
+    states = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            states.append((path, stat.st_mtime, stat.st_size))
+        except OSError:
+            states.append((path, None, None))
+    return states
 
 
 if __name__ == "__main__":
@@ -1,7 +1,12 @@
 import os
 import re
 import gzip
-import codecs
+import mmap
+import sqlite3
+import hashlib
+import itertools
+import multiprocessing
+import cPickle as pickle
 
 
 class TsdbError(Exception):
@@ -22,10 +27,10 @@ class TableReader:
             self.path = path
             self.gzipped = False
         else:
-            raise TsdbError("Missing TSDB file: {}".format(name_name))
+            raise TsdbError("Missing TSDB file: {}".format(name))
 
         if os.path.getsize(self.path) == 0:
-            raise TsdbError("Empty TSDB file: {}".format(name_name))
+            raise TsdbError("Empty TSDB file: {}".format(name))
 
     def open(self):
         if self.gzipped:
@@ -46,6 +51,121 @@ class TableReader:
             fields[rel_name] = value
         return fields
 
+    def get_converters(self, columns):
+        """
+        Returns a list of (index, converter) pairs for the named columns
+        that can be passed to convert_row.
+        """
+        pairs = []
+        for name in columns:
+            index, data_type = self.rels[name]
+            if data_type == 'integer':
+                pairs.append((index, to_integer))
+            else:
+                pairs.append((index, to_unicode))
+        return pairs
+
+    def read_rows(self, columns):
+        """
+        Generator yielding a tuple for each row of the table, containing
+        the values of only the named columns, in the order given. Only
+        these columns are decoded and converted.
+        """
+        pairs = self.get_converters(columns)
+        with self.open() as f:
+            for line in f:
+                yield convert_row(line, pairs)
+
+    def read_keyed_rows(self, columns, key_column, keys, index_dir=None):
+        """
+        Like read_rows, but only yields the rows whose value for the key
+        column is one of the given keys. The rows are located using the
+        index for the key column and yielded in file order.
+        """
+        pairs = self.get_converters(columns)
+        index = self.get_index(key_column, index_dir)
+        offsets = sorted(itertools.chain(*(index.get(k, ()) for k in keys)))
+        if not offsets:
+            return
+        if self.gzipped:
+            # gzip streams can't be entered at arbitrary points, but the
+            # offsets are sorted so seeking only ever skips forward over
+            # the decompressed rows without splitting or decoding them
+            with self.open() as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    yield convert_row(f.readline(), pairs)
+        else:
+            with open(self.path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for offset in offsets:
+                        end = data.find('\n', offset)
+                        if end == -1:
+                            end = len(data)
+                        yield convert_row(data[offset:end], pairs)
+                finally:
+                    data.close()
+
+    def get_index(self, column, index_dir=None):
+        """
+        Returns a dict mapping each value of the column to a list of
+        the byte offsets of the rows containing it. Offsets into
+        gzipped tables are offsets into the decompressed table. If an
+        index_dir is given, the index is read from its file there if
+        that is up to date, otherwise it is built and saved for next
+        time. Without one, the index is only kept in memory, so that
+        nothing is written into the profile's directory.
+        """
+        if index_dir is None:
+            return self.build_index(column)
+        index_path = self.get_index_path(column, index_dir)
+        stat = os.stat(self.path)
+        stamp = (stat.st_size, stat.st_mtime)
+        cached = read_pickle(index_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        index = self.build_index(column)
+        # if the index dir can't be written to, the index is only used
+        # for this run
+        write_pickle(index_path, (stamp, index))
+        return index
+
+    def get_index_path(self, column, index_dir):
+        filename = '{0}.{1}.idx'.format(self.name, column)
+        # tables from different profiles share names, so the index dir
+        # is partitioned by the table's path
+        digest = hashlib.md5(os.path.abspath(self.path)).hexdigest()
+        return os.path.join(index_dir, digest + '.' + filename)
+
+    def build_index(self, column):
+        pairs = self.get_converters([column])
+        index = {}
+        offset = 0
+        with self.open() as f:
+            for line in f:
+                key, = convert_row(line, pairs)
+                index.setdefault(key, []).append(offset)
+                offset += len(line)
+        return index
+
+
+def convert_row(line, pairs):
+    values = line.strip().split('@')
+    return tuple([convert(values[i]) for i, convert in pairs])
+
+
+def to_integer(value):
+    if value == '':
+        return None
+    return int(value)
+
+
+def to_unicode(value):
+    if value == '':
+        return None
+    return value.decode('utf-8')
+
 
 class TsdbProfile:
     def __init__(self, path):
@@ -84,13 +204,14 @@ class Grammar:
     def __init__(self, alias):
         self.alias = alias
 
-    def load(self, speech_prof):
+    def load(self, speech_prof, cache_dir=None, jobs=1, lazy_lexicon=False):
+        load_grammars([self], speech_prof, cache_dir, jobs, lazy_lexicon)
+
+    def find_files(self, speech_prof):
         if self.tdl == "german.tdl":
             self.tdl = "common.tdl"
         self.tdl_path = os.path.join(self.path, self.tdl)
         self.get_tdl_files(speech_prof)
-        self.load_types()
-        self.load_lexicon()
 
     def get_tdl_files(self, speech_prof):
         self.tdl_files = []
@@ -119,36 +240,42 @@ class Grammar:
                                    os.listdir(os.path.join(self.path, 'speech'))
                                    if f.endswith('.tdl')])
 
-    def load_types(self):
+    def load_types(self, tdl_contents):
+        """
+        Takes the digest and types of each of the grammar's TDL files,
+        as returned by TdlCache.read_files.
+        """
         self.types = set()
-        for tdl_file in self.tdl_files:
-            with open(os.path.join(self.path, tdl_file)) as file:
-                in_comment = False
-                for line in file:
-                    if line.startswith(';'):
-                        continue
-                    elif line.startswith('#|'):
-                        in_comment = True
-                        continue
-                    elif line.startswith('|#'):
-                        in_comment = False
-                        continue
-                    else:
-                        if not in_comment and line.find(':=') > 0:
-                            self.types.add(line.split(':=')[0].strip())
+        for digest, types in tdl_contents:
+            self.types.update(types)
 
-    def load_lexicon(self):
+    def load_lexicon(self, lex_contents):
+        """
+        Takes the digest and lexicon of each of the grammar's lexicon
+        files, as returned by TdlCache.read_files. Entries in later
+        files take precedence.
+        """
         self.lexicon = {}
-        for lex_file in self.lex_files:
-            path = os.path.join(self.path, lex_file)
-            with codecs.open(path, 'r', 'utf-8') as file:
-                for line in file:
-                    parts = re.split(':=', line)
-                    if len(parts) == 1:
-                        continue
-                    lex = parts[0].strip()
-                    lex_type = parts[1].strip(' \n&')
-                    self.lexicon[lex] = lex_type
+        # identifies the contents of the lexicon, for use in cache keys
+        fingerprint = hashlib.md5()
+        for lex_file, (digest, lexicon) in zip(self.lex_files, lex_contents):
+            fingerprint.update(lex_file)
+            fingerprint.update(digest)
+            self.lexicon.update(lexicon)
+        self.lexicon_fingerprint = fingerprint.hexdigest()
+
+    def load_lazy_lexicon(self, lex_indexes):
+        """
+        Takes the digest and index path of each of the grammar's lexicon
+        files, as returned by build_lexicon_indexes, and sets up a
+        LazyLexicon over them.
+        """
+        fingerprint = hashlib.md5()
+        for lex_file, (digest, index_path) in zip(self.lex_files, lex_indexes):
+            fingerprint.update(lex_file)
+            fingerprint.update(digest)
+        self.lexicon = LazyLexicon([p for d, p in lex_indexes])
+        self.lexicon_fingerprint = fingerprint.hexdigest()
 
     def load_lexicon_old(self, speech_prof):
         lex_files = ['lexicon.tdl']
@@ -175,6 +302,269 @@ class Grammar:
                         self.lexicon[lex] = lex_type
 
 
+def read_types(data):
+    """Returns the set of types defined in the contents of a TDL file."""
+    types = set()
+    in_comment = False
+    for line in data.split('\n'):
+        if line.startswith(';'):
+            continue
+        elif line.startswith('#|'):
+            in_comment = True
+            continue
+        elif line.startswith('|#'):
+            in_comment = False
+            continue
+        else:
+            if not in_comment and line.find(':=') > 0:
+                types.add(line.split(':=')[0].strip())
+    return types
+
+
+def read_lexicon(data):
+    """
+    Returns a dict mapping each lexical entry defined in the contents
+    of a TDL lexicon file onto its type.
+    """
+    lexicon = {}
+    for line in data.decode('utf-8').splitlines(True):
+        parts = re.split(':=', line)
+        if len(parts) == 1:
+            continue
+        lex = parts[0].strip()
+        lex_type = parts[1].strip(' \n&')
+        lexicon[lex] = lex_type
+    return lexicon
+
+
+READERS = {'types': read_types, 'lexicon': read_lexicon}
+
+
+def read_tdl_file(kind, path):
+    with open(path, 'rb') as file:
+        return READERS[kind](file.read())
+
+
+def read_tdl_file_worker(args):
+    return read_tdl_file(*args)
+
+
+def file_digest(path):
+    """Returns the MD5 hex digest of the contents of a file."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 16), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class TdlCache:
+    """
+    Holds what has been read from TDL files, keyed by the digest of
+    each file's contents. A file is only read once per run however
+    many grammars include it, and if a cache directory is given, only
+    once across runs until it changes.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def read_files(self, files, cache_dir=None, jobs=1):
+        """
+        Takes a list of (kind, path) pairs, where kind is 'types' or
+        'lexicon', and returns a list of the digest of each file paired
+        with what was read from it. Files not already read are shared
+        out between a pool of worker processes if jobs is more than 1.
+        """
+        digests = [file_digest(path) for kind, path in files]
+        unread = {}
+        for (kind, path), digest in zip(files, digests):
+            key = (kind, digest)
+            if key in self.entries or key in unread:
+                continue
+            value = None
+            if cache_dir is not None:
+                value = read_pickle(self.get_cache_path(cache_dir, key))
+            if value is None:
+                unread[key] = path
+            else:
+                self.entries[key] = value
+
+        keys = sorted(unread)
+        tasks = [(kind, unread[(kind, digest)]) for kind, digest in keys]
+        jobs = min(jobs, len(tasks))
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                values = pool.map(read_tdl_file_worker, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            values = [read_tdl_file(*task) for task in tasks]
+        for key, value in zip(keys, values):
+            self.entries[key] = value
+            if cache_dir is not None:
+                write_pickle(self.get_cache_path(cache_dir, key), value)
+
+        return [(digest, self.entries[(kind, digest)]) 
+                for (kind, path), digest in zip(files, digests)]
+
+    def get_cache_path(self, cache_dir, key):
+        return os.path.join(cache_dir, '{0}-{1}.pickle'.format(*key))
+
+
+TDL_CACHE = TdlCache()
+
+
+def read_pickle(path):
+    """Returns the object pickled in the file, or None if there isn't one."""
+    try:
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+    except Exception:
+        return None
+
+
+def write_pickle(path, obj):
+    """
+    Pickles the object into the file, by way of a temporary file so
+    that concurrent readers never see a partial pickle. Failure to
+    write is ignored, as the file only ever serves as a cache.
+    """
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(obj, file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+class LazyLexicon:
+    """
+    A read-only mapping of lexical entries onto their types, backed by
+    an on-disk index of each lexicon file. Entries are looked up as
+    they are needed and then remembered, rather than every lexicon
+    being loaded into memory up front.
+    """
+    def __init__(self, index_paths):
+        # entries in later files take precedence, so search them first
+        self.index_paths = index_paths[::-1]
+        self.entries = {}
+        self.connections = None
+        self.pid = None
+
+    def __getitem__(self, lex):
+        try:
+            lex_type = self.entries[lex]
+        except KeyError:
+            lex_type = self.entries[lex] = self.lookup(lex)
+        if lex_type is None:
+            raise KeyError(lex)
+        return lex_type
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connections'] = state['pid'] = None
+        return state
+
+    def lookup(self, lex):
+        if self.pid != os.getpid():
+            # connections can't be shared with forked worker processes
+            self.connections = [sqlite3.connect(path) 
+                                for path in self.index_paths]
+            self.pid = os.getpid()
+        for connection in self.connections:
+            row = connection.execute('SELECT type FROM lexicon WHERE lex = ?',
+                                     (lex,)).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+
+def build_lexicon_index(path, index_path):
+    """Writes an sqlite index of the entries in a lexicon file."""
+    with open(path, 'rb') as file:
+        lexicon = read_lexicon(file.read())
+    tmp_path = '{0}.{1}.tmp'.format(index_path, os.getpid())
+    connection = sqlite3.connect(tmp_path)
+    connection.execute('CREATE TABLE lexicon (lex TEXT PRIMARY KEY, type TEXT)')
+    connection.executemany('INSERT INTO lexicon VALUES (?, ?)', 
+                           lexicon.iteritems())
+    connection.commit()
+    connection.close()
+    os.rename(tmp_path, index_path)
+
+
+def build_lexicon_index_worker(args):
+    return build_lexicon_index(*args)
+
+
+def build_lexicon_indexes(paths, cache_dir, jobs=1):
+    """
+    Returns a list of the digest of each lexicon file paired with the
+    path of its index in the cache directory, building the indexes of
+    any files that don't have one yet.
+    """
+    digests = [file_digest(path) for path in paths]
+    index_paths = [os.path.join(cache_dir, 'lexicon-{0}.sqlite'.format(d)) 
+                   for d in digests]
+    unbuilt = {}
+    for path, index_path in zip(paths, index_paths):
+        if not os.path.exists(index_path):
+            unbuilt[index_path] = path
+    tasks = [(path, index_path) for index_path, path in sorted(unbuilt.items())]
+    jobs = min(jobs, len(tasks))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            pool.map(build_lexicon_index_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            build_lexicon_index(*task)
+    return zip(digests, index_paths)
+
+
+def load_grammars(grammars, speech_prof, cache_dir=None, jobs=1, 
+                  lazy_lexicon=False):
+    """
+    Loads the types and lexicons of the grammars together, so that the
+    TDL files of all of them are read by one pool of workers and files
+    the grammars have in common are only read once. With lazy_lexicon,
+    the lexicons are indexed in the cache directory and entries are
+    only looked up as they are needed.
+    """
+    files = []
+    lex_paths = []
+    for grammar in grammars:
+        grammar.find_files(speech_prof)
+        files.extend(('types', os.path.join(grammar.path, f)) 
+                     for f in grammar.tdl_files)
+        lex_paths.extend(os.path.join(grammar.path, f) 
+                         for f in grammar.lex_files)
+    if lazy_lexicon:
+        contents = TDL_CACHE.read_files(files, cache_dir, jobs)
+        lex_contents = build_lexicon_indexes(lex_paths, cache_dir, jobs)
+    else:
+        files.extend(('lexicon', path) for path in lex_paths)
+        contents = TDL_CACHE.read_files(files, cache_dir, jobs)
+        lex_contents = contents[len(contents) - len(lex_paths):]
+
+    types_start = lex_start = 0
+    for grammar in grammars:
+        types_end = types_start + len(grammar.tdl_files)
+        lex_end = lex_start + len(grammar.lex_files)
+        grammar.load_types(contents[types_start:types_end])
+        if lazy_lexicon:
+            grammar.load_lazy_lexicon(lex_contents[lex_start:lex_end])
+        else:
+            grammar.load_lexicon(lex_contents[lex_start:lex_end])
+        types_start, lex_start = types_end, lex_end
+
+
 def find_grammars(logonroot):
     grammars = {}
     reg_path = os.path.join(logonroot, 'etc', 'registry')
@@ -0,0 +1,138 @@
+"""
+A sparse matrix relating the items of the profiles being compared to
+the attributes found in their results, stored in compressed sparse row
+(CSR) form. Row i holds the attributes of the i-th item, with each
+attribute ID as a column and the number of the item's results that
+contain the attribute as the value. The counts of attributes over a
+set of items are then sums over the columns of a slice of rows.
+"""
+
+from array import array
+
+try:
+    import numpy
+    from scipy import sparse
+    SCIPY = True
+except ImportError:
+    SCIPY = False
+
+
+class ItemMatrix:
+    def __init__(self):
+        self.indptr = array('i', [0])
+        self.indices = array('i')
+        self.data = array('i')
+        self.csr = None
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def append(self, attribute_ids):
+        """
+        Add a row for an item, given the attribute IDs of each of its
+        results one after the other, as returned by Item.attribute_ids.
+        """
+        attribute_ids = sorted(attribute_ids)
+        last = None
+        for attribute_id in attribute_ids:
+            if attribute_id == last:
+                self.data[-1] += 1
+            else:
+                self.indices.append(attribute_id)
+                self.data.append(1)
+                last = attribute_id
+        self.indptr.append(len(self.indices))
+
+    def finalize(self, num_columns):
+        """Called once all the rows have been added."""
+        self.num_columns = num_columns
+        if SCIPY:
+            self.csr = sparse.csr_matrix(
+                (numpy.frombuffer(self.data, dtype=numpy.intc),
+                 numpy.frombuffer(self.indices, dtype=numpy.intc),
+                 numpy.frombuffer(self.indptr, dtype=numpy.intc)),
+                shape=(len(self), num_columns))
+
+    def row(self, row):
+        """The sorted attribute IDs of the item in a row."""
+        return self.indices[self.indptr[row]:self.indptr[row+1]]
+
+    def column_sums(self, rows, binary=False):
+        """
+        Returns a dict of each attribute ID occurring in the given rows
+        and the sum of its column over them. With binary, the number
+        of rows the attribute occurs in is counted instead.
+        """
+        if SCIPY:
+            rows = self.csr[list(rows)]
+            if binary:
+                rows.data[:] = 1
+            sums = rows.sum(axis=0).A1
+            nonzero = sums.nonzero()[0]
+            return dict(zip(nonzero.tolist(), sums[nonzero].tolist()))
+        sums = {}
+        for row in rows:
+            start, end = self.indptr[row], self.indptr[row+1]
+            for i in xrange(start, end):
+                attribute_id = self.indices[i]
+                value = 1 if binary else self.data[i]
+                sums[attribute_id] = sums.get(attribute_id, 0) + value
+        return sums
+
+    def group_column_sums(self, groups, binary=False):
+        """
+        Like column_sums, for each of a list of groups of rows, with
+        the sums of every group found at once.
+        """
+        if not SCIPY:
+            return [self.column_sums(rows, binary) for rows in groups]
+        rows = [row for group in groups for row in group]
+        matrix = self.csr[rows]
+        if binary:
+            matrix.data[:] = 1
+        # a matrix with a row for each group and a 1 in the column of
+        # each of the group's rows
+        labels = [i for i, group in enumerate(groups) for row in group]
+        membership = sparse.csr_matrix(
+            (numpy.ones(len(rows), dtype=numpy.intc), 
+             (labels, numpy.arange(len(rows)))),
+            shape=(len(groups), len(rows)))
+        sums = (membership * matrix).tocsr()
+        sums.eliminate_zeros()
+        return [dict(zip(sums.indices[start:end].tolist(), 
+                         sums.data[start:end].tolist()))
+                for start, end in zip(sums.indptr[:-1], sums.indptr[1:])]
+
+    def weighted_matrix(self, rows, columns, weights):
+        """
+        Returns a sparse matrix with a row for each of the given rows,
+        in which column i is weights[i] if the item has the attribute
+        columns[i] and 0 otherwise. Requires scipy.
+        """
+        rows = self.csr[list(rows)][:, columns]
+        rows.data[:] = 1
+        weights = sparse.diags(numpy.asarray(weights, dtype=float))
+        matrix = (rows * weights).tocsr()
+        matrix.eliminate_zeros()
+        return matrix
+
+    def weighted_rows(self, rows, columns, weights):
+        """
+        Returns dense vectors for the given rows, with the i-th value
+        of each being weights[i] if the item contains the attribute
+        columns[i] and 0 otherwise.
+        """
+        if SCIPY:
+            matrix = self.weighted_matrix(rows, columns, weights)
+            return list(matrix.toarray())
+        positions = dict((attribute_id, i) for i, attribute_id
+                         in enumerate(columns))
+        vectors = []
+        for row in rows:
+            vector = [0] * len(columns)
+            for attribute_id in self.row(row):
+                i = positions.get(attribute_id)
+                if i is not None:
+                    vector[i] = weights[i]
+            vectors.append(vector)
+        return vectors
@@ -8,6 +8,7 @@ import itertools
 from jinja2 import Environment, FileSystemLoader
 
 import cluster
+from profile import VOCAB
 
 
 class View:
@@ -100,11 +101,15 @@ class Output:
         self.common_data = self.get_common_data()
 
     def check_out_dir(self):
-        if not os.path.isdir(self.gopts.out_dir):
-            os.makedirs(self.gopts.out_dir)
         static_path = os.path.join(self.gopts.out_dir, self.static_dir)
-        if not os.path.isdir(static_path): 
-            os.makedirs(static_path)
+        for path in (self.gopts.out_dir, static_path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # already there, or made by another process writing the
+                # report for a different new grammar
+                if not os.path.isdir(path):
+                    raise
 
     def copy_static_files(self):
         for sfile in self.static_files:
@@ -117,10 +122,12 @@ class Output:
         for parse_cat in self.pdiff.parse_cats:
             parse_cat.html_heading = parse_cat.title.replace(
                 '->', '&rarr;').replace('*parse*', '<u>parse</u>')
-            parse_cat.top_attributes = sorted(
-                parse_cat.attribute_counts.keys(), 
-                key=lambda x:parse_cat.attribute_counts[x], 
-                reverse=True)
+            counts = dict((VOCAB[i], c) for i, c in 
+                          parse_cat.attribute_counts.iteritems())
+            parse_cat.named_attribute_counts = counts
+            parse_cat.top_attributes = sorted(sorted(counts), 
+                                              key=lambda x:counts[x], 
+                                              reverse=True)
 
         data = {
             'views' : self.views,
@@ -142,12 +149,10 @@ class Output:
         self.env.filters['parse_status'] = parse_status
         data['profile_names'] = ", ".join(self.pdiff.profile_names)
         data['num_profiles'] = len(self.pdiff.profile_names)
-        data['num_prev_feats'] = sum(1 for f in 
-                                     self.pdiff.attributes.values() 
-                                     if f.prev_counts != 0)
-        data['num_new_feats'] = sum(1 for f in 
-                                    self.pdiff.attributes.values() 
-                                    if f.new_counts != 0)
+        data['num_prev_feats'] = self.pdiff.attributes.count_nonzero(
+            'prev_counts')
+        data['num_new_feats'] = self.pdiff.attributes.count_nonzero(
+            'new_counts')
         data['num_items'] = self.pdiff.num_items
         data['num_errors_prev'] = self.pdiff.prev_errors
         data['num_errors_new'] = self.pdiff.new_errors
@@ -174,27 +179,30 @@ class Output:
         data['top_attributes'] = self.get_top_attribute_changes(20)
 
     def get_top_attribute_changes(self, num_tops):
-        top_increases = sorted(self.pdiff.attributes.values(), 
-                               key=lambda x:x.change, 
-                               reverse=True)[:num_tops]
-        top_decreases = sorted(self.pdiff.attributes.values(), 
-                               key=lambda x:x.change)[:num_tops]
+        attributes = self.pdiff.attributes
+        top_increases = attributes.sorted('change', reverse=True, num=num_tops)
+        top_decreases = attributes.sorted('change', num=num_tops)
         return itertools.izip_longest(top_increases, top_decreases, 
                                       fillvalue=None)
 
     def add_attributes_data(self, data):
-        data['sorted_attributes'] = sorted(self.pdiff.attributes.values(),
-                                key=lambda x:x.change_size, reverse=True)
+        data['sorted_attributes'] = self.pdiff.attributes.sorted(
+            'change_size', reverse=True)
 
     def add_errors_data(self, data):
         self.pdiff.error_list.sort(key=lambda x:x.id)
         data['errors'] = self.pdiff.error_list
 
     def add_items_data(self, data):
-        self.pdiff.item_list.sort(key=lambda x:x[0].id)
-        data['item_list'] = self.pdiff.item_list
+        # a generator, so that the items are rendered as they are read
+        # when the items are kept on disk
+        data['item_list'] = ((prev_item, new_item, sorted(VOCAB.resolve(
+                    self.pdiff.item_attribute_ids(row))))
+                             for prev_item, new_item, row in 
+                             self.pdiff.sorted_items())
                
     def add_clusters_data(self, data):
+        data['num_top_attributes'] = self.gopts.top_attributes
         for parse_cat in self.pdiff.parse_cats:
             results = parse_cat.results         
             if results is None:
@@ -203,10 +211,12 @@ class Output:
                 continue
             for cluster in results.clusters:
                 cluster.points.sort(key=lambda x:x.silhouette, reverse=True)
-                top_feats = sorted(cluster.nearest_point.item.attributes, 
+                exemplar_attributes = sorted(VOCAB.resolve(
+                        parse_cat.matrix.row(cluster.nearest_point.row)))
+                top_feats = sorted(exemplar_attributes, 
                                    key=lambda x:self.pdiff.attributes[x].cluster_weight, 
-                                   reverse=True)[:5]
-                metrics = cluster.get_metrics(top_feats, results.clusters)
+                                   reverse=True)[:self.gopts.top_attributes]
+                metrics = cluster.get_metrics(top_feats, results)
                 cluster.top_attributes = []
                 for f,c,o in metrics:
                     cluster.top_attributes.append({
@@ -223,7 +233,59 @@ class Output:
             view.data.update(self.common_data)
             for ftype in self.ftypes:
                 template = view.name + '.' + ftype
-                output = self.env.get_template(template).render(view.data)
+                stream = self.env.get_template(template).stream(view.data)
                 with open(view.paths[ftype], 'w') as f:
-                    f.write(output.encode('utf-8'))
+                    stream.dump(f, 'utf-8')
         
+
+
+class Revision:
+    """
+    The figures for one new grammar shown in the cross-revision
+    summary. Only plain values are kept, so that Revisions can be sent
+    back from the processes comparing each new grammar.
+    """
+    def __init__(self, pdiff, summary_file):
+        self.version = pdiff.new_grammar.version
+        self.summary_file = summary_file
+        self.num_items = pdiff.num_items
+        self.parsing_items = pdiff.new_parsing_items
+        self.coverage = 100 * pdiff.new_parsing_items / pdiff.num_items
+        self.readings = pdiff.new_readings
+        self.errors = pdiff.new_errors
+        self.num_now_parses = pdiff.now_parses.num_total_items
+        self.num_now_no_parse = pdiff.now_no_parse.num_total_items
+        self.num_changed_readings = pdiff.still_parses_new.num_total_items
+        self.num_changed_attributes = pdiff.attributes.count_nonzero('change')
+
+
+class RevisionsOutput:
+    """
+    Writes the cross-revision summary, comparing the previous grammar
+    against each of a number of new grammars.
+    """
+    def __init__(self, grammar_name, prev_grammar, profile_alias, 
+                 profile_names, revisions, gopts):
+        self.gopts = gopts
+        self.env = Environment(loader=FileSystemLoader(
+                os.path.join(gopts.script_dir, 'html')))
+        filename = "{0}_{1}_{2}_revisions.html".format(grammar_name, 
+                                                       prev_grammar.version,
+                                                       profile_alias)
+        self.path = os.path.join(gopts.out_dir, filename)
+        self.data = {
+            'title' : 'gDelta revisions',
+            'views' : [],
+            'static_dir' : Output.static_dir,
+            'js_files' : Output.js_files,
+            'css_files' : Output.css_files,
+            'gram_name' : grammar_name,
+            'prev_gram' : prev_grammar,
+            'profile_names' : ", ".join(profile_names),
+            'revisions' : revisions
+            }
+
+    def do_output(self):
+        stream = self.env.get_template('revisions.html').stream(self.data)
+        with open(self.path, 'w') as f:
+            stream.dump(f, 'utf-8')
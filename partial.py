@@ -0,0 +1,144 @@
+"""
+Splitting a comparison across independent processes or machines.
+
+In map mode, each shard loads and processes its share of the member
+profiles of a virtual profile under both grammars and writes them to a
+partial result file. In reduce mode, the partial results of all of the
+shards are read back and merged into LoadedProfiles, from which the
+full Pdiff, clustering and output are produced as usual. The items,
+readings, errors and attributes of each profile are all contained in
+its pickled Profile, and the parse changes and attribute counts are
+recomputed from them when merging.
+"""
+
+import os
+import re
+import cPickle as pickle
+
+from pdiff import LoadedProfiles, load_profile_pairs
+
+
+# bump this whenever a change is made to what a partial result contains
+PARTIAL_VERSION = 1
+
+
+class PartialError(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+        self.msg = msg
+
+
+def parse_shard(arg):
+    """
+    Returns the shard number and number of shards given by a string
+    like '2/5', or None if it isn't valid.
+    """
+    match = re.match(r'^(\d+)/(\d+)$', arg)
+    if match is None:
+        return None
+    shard, num_shards = int(match.group(1)), int(match.group(2))
+    if not 1 <= shard <= num_shards:
+        return None
+    return shard, num_shards
+
+
+def get_file_base(prev_grammar, new_grammar, profile_alias):
+    return "{0}_{1}-{2}_{3}".format(prev_grammar.name, prev_grammar.version,
+                                    new_grammar.version, profile_alias)
+
+
+def get_partial_path(out_dir, prev_grammar, new_grammar, profile_alias,
+                     shard, num_shards):
+    filename = "{0}.{1}-of-{2}.partial".format(
+        get_file_base(prev_grammar, new_grammar, profile_alias),
+        shard, num_shards)
+    return os.path.join(out_dir, filename)
+
+
+def write_partial(prev_grammar, new_grammar, profile_alias, profile_names,
+                  shard, num_shards, gopts):
+    """
+    Processes every num_shards-th profile, starting with the shard-th,
+    and writes them to a partial result file in the output directory,
+    returning its path.
+    """
+    shard_names = profile_names[shard-1::num_shards]
+    # loaded in pairs, so that the derivations scanned for each profile
+    # of the previous grammar can be reused for the new grammar
+    prev_profiles = []
+    new_profiles = []
+    for prev, new, changes in load_profile_pairs(shard_names, prev_grammar,
+                                                 new_grammar, gopts):
+        prev_profiles.append(prev)
+        new_profiles.append(new)
+    partial = {
+        'version' : PARTIAL_VERSION,
+        'shard' : shard,
+        'num_shards' : num_shards,
+        'profile_names' : profile_names,
+        'prev_profiles' : prev_profiles,
+        'new_profiles' : new_profiles,
+        }
+    if not os.path.isdir(gopts.out_dir):
+        os.makedirs(gopts.out_dir)
+    path = get_partial_path(gopts.out_dir, prev_grammar, new_grammar,
+                            profile_alias, shard, num_shards)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(partial, file, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+    return path
+
+
+def read_partials(partial_dir, prev_grammar, new_grammar, profile_alias,
+                  gopts):
+    """
+    Reads the partial results of every shard of the comparison from
+    the directory, returning the names of all the profiles and the
+    LoadedProfiles of each grammar. Raises PartialError if any shards
+    are missing or the partials don't belong together.
+    """
+    pattern = re.escape(get_file_base(prev_grammar, new_grammar,
+                                      profile_alias))
+    pattern += r'\.(\d+)-of-(\d+)\.partial$'
+    paths = {}
+    for filename in sorted(os.listdir(partial_dir)):
+        match = re.match(pattern, filename)
+        if match is not None:
+            shard, num_shards = int(match.group(1)), int(match.group(2))
+            paths.setdefault(num_shards, {})[shard] = os.path.join(partial_dir,
+                                                                   filename)
+    if len(paths) != 1:
+        msg = "Expected the partial results of one set of shards in {0}, " \
+            "found {1}."
+        raise PartialError(msg.format(partial_dir, len(paths)))
+    num_shards, shard_paths = paths.popitem()
+    missing = [str(s) for s in range(1, num_shards + 1)
+               if s not in shard_paths]
+    if missing:
+        msg = "Missing the partial results of shard(s) {0} of {1} in {2}."
+        raise PartialError(msg.format(', '.join(missing), num_shards,
+                                      partial_dir))
+
+    prev_profiles = LoadedProfiles(prev_grammar, [], gopts)
+    new_profiles = LoadedProfiles(new_grammar, [], gopts)
+    profile_names = None
+    for shard in range(1, num_shards + 1):
+        with open(shard_paths[shard], 'rb') as file:
+            partial = pickle.load(file)
+        if partial['version'] != PARTIAL_VERSION:
+            msg = "The partial result {0} was written by a different " \
+                "version of gDelta."
+            raise PartialError(msg.format(shard_paths[shard]))
+        if profile_names is None:
+            profile_names = partial['profile_names']
+        elif partial['profile_names'] != profile_names:
+            msg = "The partial result {0} is for different profiles."
+            raise PartialError(msg.format(shard_paths[shard]))
+        for profile in partial['prev_profiles']:
+            profile.attach(prev_grammar, gopts)
+            prev_profiles.add(profile)
+        for profile in partial['new_profiles']:
+            profile.attach(new_grammar, gopts)
+            new_profiles.add(profile)
+    return profile_names, prev_profiles, new_profiles
@@ -1,76 +1,251 @@
 from __future__ import division
-from collections import defaultdict
 
+import os
+import sys
 import math
+import tempfile
 import itertools
+import multiprocessing
+import cPickle as pickle
+from array import array
 
-from profile import Profile
+try:
+    import numpy
+    NUMPY = True
+except ImportError:
+    NUMPY = False
 
+import cache
+from matrix import ItemMatrix
+from profile import VOCAB, DERIVATIONS
 
-class Attribute:
-    def __init__(self, name, prev_counts, new_counts, prev_parses, new_parses,
-                 prev_types, new_types, weight_type):
-        self.name = name
-        self.prev_counts = prev_counts
-        self.new_counts = new_counts
-        self.change = new_counts - prev_counts
-        self.change_size = abs(self.change)
-
-        prev_idf = math.log((prev_parses + new_parses)/(1 + prev_counts) + 1)
-        new_idf = math.log((new_parses + prev_parses)/(1 + new_counts) + 1)
-        self.weight = abs(new_idf - prev_idf)
+
+STATUS_BOTH, STATUS_OLD, STATUS_NEW, STATUS_NEITHER = range(4)
+STATUS_NAMES = ('both', 'old', 'new', '')
+
+
+class AttributeTable:
+    """
+    The attributes found in the profiles, stored column-wise: row i of
+    each column holds the value for the i-th attribute, with the rows
+    ordered by attribute name. The counts, changes and weights are
+    computed for all attributes at once, using numpy where available.
+    """
+    def __init__(self, attribute_ids, prev_counts, new_counts, prev_parses, 
+                 new_parses, prev_types, new_types, weight_type):
+        self.ids = attribute_ids
+        self.names = [VOCAB[i] for i in attribute_ids]
+        self.rows = dict((name, i) for i, name in enumerate(self.names))
+        self.id_rows = dict((a, i) for i, a in enumerate(attribute_ids))
+
+        self.prev_counts = make_column(prev_counts)
+        self.new_counts = make_column(new_counts)
+        self.change = [n - p for p, n in zip(prev_counts, new_counts)]
+        self.change_size = [abs(c) for c in self.change]
+        total_parses = prev_parses + new_parses
+        if NUMPY:
+            self.change = numpy.array(self.change)
+            self.change_size = numpy.array(self.change_size)
+            prev_idf = numpy.log(total_parses/(1 + self.prev_counts) + 1)
+            new_idf = numpy.log(total_parses/(1 + self.new_counts) + 1)
+            self.weight = numpy.abs(new_idf - prev_idf)
+        else:
+            self.weight = [abs(math.log(total_parses/(1 + n) + 1) - 
+                               math.log(total_parses/(1 + p) + 1))
+                           for p, n in zip(prev_counts, new_counts)]
 
         if weight_type == 'count':
             self.cluster_weight = self.change_size
         elif weight_type == 'delta_idf2':
-            self.cluster_weight = pow(self.weight, 2)
+            self.cluster_weight = make_column([w*w for w in self.weight])
         else:
             self.cluster_weight = self.weight
 
-        in_prev = name in prev_types
-        in_new = name in new_types
-        if in_prev and in_new:
-            self.status = 'both'
-        elif in_prev and not in_new:
-            self.status = 'old'
-        elif not in_prev and in_new:
-            self.status = 'new'
+        self.status = make_column([get_status(name in prev_types, 
+                                              name in new_types)
+                                   for name in self.names])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __getitem__(self, name):
+        return Attribute(self, self.rows[name])
+
+    def values(self):
+        return [Attribute(self, i) for i in xrange(len(self.names))]
+
+    def count_nonzero(self, column):
+        return sum(1 for value in getattr(self, column) if value != 0)
+
+    def sorted(self, column, reverse=False, num=None):
+        """
+        Returns the attributes sorted by the values of a column, and
+        then by name, optionally only the first num of them.
+        """
+        values = getattr(self, column)
+        if NUMPY:
+            if reverse:
+                values = -values
+            order = numpy.argsort(values, kind='mergesort')[:num]
+        else:
+            order = sorted(xrange(len(values)), key=values.__getitem__, 
+                           reverse=reverse)[:num]
+        return [Attribute(self, i) for i in order]
+
+
+class Attribute:
+    """A view onto the row of an AttributeTable for one attribute."""
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def name(self):
+        return self.table.names[self.row]
+
+    @property
+    def id(self):
+        return self.table.ids[self.row]
+
+    @property
+    def prev_counts(self):
+        return int(self.table.prev_counts[self.row])
+
+    @property
+    def new_counts(self):
+        return int(self.table.new_counts[self.row])
+
+    @property
+    def change(self):
+        return int(self.table.change[self.row])
+
+    @property
+    def change_size(self):
+        return int(self.table.change_size[self.row])
+
+    @property
+    def weight(self):
+        return float(self.table.weight[self.row])
+
+    @property
+    def cluster_weight(self):
+        return self.table.cluster_weight[self.row].item() if NUMPY else \
+            self.table.cluster_weight[self.row]
+
+    @property
+    def status(self):
+        return STATUS_NAMES[self.table.status[self.row]]
+
+
+def get_status(in_prev, in_new):
+    if in_prev and in_new:
+        return STATUS_BOTH
+    elif in_prev:
+        return STATUS_OLD
+    elif in_new:
+        return STATUS_NEW
+    return STATUS_NEITHER
+
+
+def make_column(values):
+    """Returns a numpy array of the values if numpy is available."""
+    if NUMPY:
+        return numpy.array(values)
+    return list(values)
 
 
 class ParseCat:
-    def __init__(self, title, desc, gopts):
+    def __init__(self, title, desc, gopts, matrix):
         self.title = title
         self.desc = desc
         self.gopts = gopts
+        self.matrix = matrix
         self.items = {}
+        self.rows = {}
+        self.used = {}
+        # when streaming, the items themselves are only kept if they
+        # are to be clustered
+        self.keep_items = gopts.clustering or not gopts.stream
 
-    def add_items(self, item_ids, profile):
+    def add_items(self, item_ids, profile, rows):
         for i in item_ids:
-            self.items[i] = profile[i]
+            item = profile[i]
+            self.rows[i] = rows[i]
+            self.used[i] = item.used
+            if self.keep_items:
+                self.items[i] = item
 
     def finalize(self):
-        self.used_items = [item for item in self.items.values() if item.used]
-        self.num_total_items = len(self.items)
-        self.num_used_items = len(self.used_items)
+        self.used_items = []
+        self.used_rows = []
+        for item_id, row in self.rows.iteritems():
+            if self.used[item_id]:
+                self.used_rows.append(row)
+                if self.keep_items:
+                    self.used_items.append(self.items[item_id])
+        self.num_total_items = len(self.rows)
+        self.num_used_items = len(self.used_rows)
         self.num_unused_items = self.num_total_items - self.num_used_items
-        self.attribute_counts = self.get_attribute_counts()
-
-    def get_attribute_counts(self):
-        attribute_counts = defaultdict(int)
-        for item in self.used_items:
-            for attribute in item.attributes:
-                attribute_counts[attribute] += 1
-        return attribute_counts
+        self.attribute_counts = self.matrix.column_sums(self.used_rows)
 
         
+class LoadedProfiles:
+    """
+    The processed profiles of a grammar, kept so that they can be
+    compared more than once, eg against each of a number of new
+    grammars. With keep_derivations, the derivations scanned while
+    loading them are kept for the profiles of the other grammars,
+    until DERIVATIONS.release is called.
+    """
+    def __init__(self, grammar, profile_names, gopts, 
+                 keep_derivations=False):
+        self.grammar = grammar
+        self.gopts = gopts
+        self.profiles = {}
+        self.used = {}
+        if keep_derivations:
+            DERIVATIONS.keep()
+            self.load(profile_names)
+            DERIVATIONS.stop_keeping()
+        else:
+            self.load(profile_names)
+
+    def load(self, profile_names):
+        """(Re)loads the named profiles."""
+        for profile in load_profiles(profile_names, self.grammar, self.gopts):
+            self.add(profile)
+
+    def add(self, profile):
+        """Adds a profile of the grammar that has already been loaded."""
+        self.profiles[profile.name] = profile
+        self.used[profile.name] = dict((item_id, item.used) for item_id, 
+                                       item in profile.items.iteritems())
+
+    def reset(self):
+        """
+        Restores whether each item is used, which Pdiff changes when
+        the corresponding item of the other grammar has an error.
+        """
+        for profile_name, profile in self.profiles.iteritems():
+            used = self.used[profile_name]
+            for item_id, item in profile.items.iteritems():
+                item.used = used[item_id]
+
+
 class Pdiff:
-    def __init__(self, prev_gram, new_gram, profile_alias, profile_names, gopts):
+    def __init__(self, prev_gram, new_gram, profile_alias, profile_names, gopts,
+                 prev_profiles=None, new_profiles=None):
         self.grammar_name = prev_gram.name
         self.prev_grammar = prev_gram
         self.new_grammar = new_gram
         self.profile_alias = profile_alias
         self.profile_names = profile_names
         self.gopts = gopts
+        self.prev_profiles = prev_profiles
+        self.new_profiles = new_profiles
 
         # parse change categories
         desc1 = "Items that previously did not parse but now do."
@@ -80,10 +255,17 @@ class Pdiff:
             "grammar."
         desc4 = "Items whose parsability did not change, but number of " \
             "readings did; attributes taken from the results of the new grammar."
-        self.now_parses = ParseCat("no parse -> parse", desc1, gopts)
-        self.now_no_parse = ParseCat("parse -> no parse", desc2, gopts) 
-        self.still_parses_prev = ParseCat("*parse* -> parse", desc3, gopts)
-        self.still_parses_new = ParseCat("parse -> *parse*", desc4, gopts)
+        # one row per item for each grammar, in the order of item_list
+        self.prev_matrix = ItemMatrix()
+        self.new_matrix = ItemMatrix()
+        self.now_parses = ParseCat("no parse -> parse", desc1, gopts, 
+                                   self.new_matrix)
+        self.now_no_parse = ParseCat("parse -> no parse", desc2, gopts, 
+                                     self.prev_matrix) 
+        self.still_parses_prev = ParseCat("*parse* -> parse", desc3, gopts, 
+                                          self.prev_matrix)
+        self.still_parses_new = ParseCat("parse -> *parse*", desc4, gopts, 
+                                         self.new_matrix)
         self.parse_cats = (self.now_parses, 
                            self.now_no_parse,
                            self.still_parses_prev,
@@ -96,10 +278,14 @@ class Pdiff:
 
     def get_and_process_profiles(self):
         self.profiles = {}
-        self.item_list = []
+        if self.gopts.stream:
+            self.item_list = ItemStore()
+        else:
+            self.item_list = []
         self.error_list = []
-        self.prev_attribute_counts = defaultdict(int) 
-        self.new_attribute_counts = defaultdict(int)
+        # rows of the items that were used by their own profile
+        self.prev_used_rows = []
+        self.new_used_rows = []
         self.num_items = 0
         self.prev_readings = 0
         self.new_readings = 0
@@ -107,24 +293,69 @@ class Pdiff:
         self.new_parsing_items = 0
         self.prev_errors = 0
         self.new_errors = 0
-        for profile_name in self.profile_names:
-            prev = Profile(profile_name, self.prev_grammar, self.gopts)
-            new = Profile(profile_name, self.new_grammar, self.gopts)
-            self.profiles[profile_name] = (prev, new)
+        for prev, new, changes in self.load_profiles():
+            if not self.gopts.stream:
+                self.profiles[prev.name] = (prev, new)
             self.num_items += len(prev.items) 
             self.prev_readings += prev.tot_readings
             self.new_readings += new.tot_readings
-            self.calc_parse_changes(prev, new)
-            self.add_attribute_counts(self.prev_attribute_counts, prev)
-            self.add_attribute_counts(self.new_attribute_counts, new)
-            self.process_items(prev, new)
+            rows = self.process_items(prev, new)
+            self.calc_parse_changes(prev, new, changes, rows)
+        self.prev_matrix.finalize(len(VOCAB))
+        self.new_matrix.finalize(len(VOCAB))
+        # the number of results each attribute occurs in
+        self.prev_attribute_counts = self.prev_matrix.column_sums(
+            self.prev_used_rows)
+        self.new_attribute_counts = self.new_matrix.column_sums(
+            self.new_used_rows)
+
+    def load_profiles(self):
+        """
+        Generator yielding the previous and new Profiles and their parse
+        changes for each profile name, in the order of the profile
+        names. With more than one job, the profiles are loaded by a pool
+        of worker processes. Profiles that have already been loaded are
+        taken from prev_profiles and new_profiles.
+        """
+        if self.prev_profiles is not None:
+            self.prev_profiles.reset()
+            if self.new_profiles is not None:
+                self.new_profiles.reset()
+                new_profiles = (self.new_profiles.profiles[profile_name] 
+                                for profile_name in self.profile_names)
+            else:
+                new_profiles = load_profiles(self.profile_names, 
+                                             self.new_grammar, self.gopts)
+            for profile_name, new in itertools.izip(self.profile_names, 
+                                                    new_profiles):
+                prev = self.prev_profiles.profiles[profile_name]
+                yield prev, new, get_parse_changes(prev, new)
+            return
+
+        for prev, new, changes in load_profile_pairs(self.profile_names, 
+                                                     self.prev_grammar,
+                                                     self.new_grammar, 
+                                                     self.gopts):
+            yield prev, new, changes
 
     def process_items(self, prev, new):
+        """
+        Adds the items of a pair of profiles to item_list and their
+        attributes to the matrices, returning the row of each item ID.
+        """
+        rows = {}
         prev_values = prev.items.values()
         new_values = new.items.values()
         for prev_item, new_item in itertools.izip(prev_values, new_values):
-            union_attributes = set(prev_item.attributes + new_item.attributes)
-            self.item_list.append((prev_item, new_item, union_attributes))
+            row = len(self.item_list)
+            rows[prev_item.id] = row
+            self.item_list.append((prev_item, new_item, row))
+            self.prev_matrix.append(prev_item.attribute_ids)
+            self.new_matrix.append(new_item.attribute_ids)
+            if prev_item.used:
+                self.prev_used_rows.append(row)
+            if new_item.used:
+                self.new_used_rows.append(row)
 
             if prev_item.error != None:
                 self.error_list.append(prev_item)
@@ -136,45 +367,218 @@ class Pdiff:
                 self.new_errors += 1
                 if not new_item.used:
                     prev_item.used = False
+        return rows
 
-    def calc_parse_changes(self, prev, new):
+    def sorted_items(self):
         """
-        Note that parse -> parse only includes those items whose
-        number of readings has not changed.
+        Returns the previous and new item and the row of every item,
+        sorted by item ID.
         """
+        if self.gopts.stream:
+            return self.item_list.sorted_items()
+        self.item_list.sort(key=lambda x:x[0].id)
+        return self.item_list
+
+    def item_attribute_ids(self, row):
+        """The union of the attribute IDs of the items in a row."""
+        attribute_ids = set(self.prev_matrix.row(row))
+        attribute_ids.update(self.new_matrix.row(row))
+        return attribute_ids
+
+    def calc_parse_changes(self, prev, new, changes, rows):
         self.prev_parsing_items += len(prev.has_readings)
         self.new_parsing_items += len(new.has_readings)
-        still_parses = set(prev.has_readings).intersection(new.has_readings)
-        still_parses = [i for i in still_parses 
-                        if prev[i].tot_readings != new[i].tot_readings]
-        now_parses = set(prev.no_readings).intersection(new.has_readings)
-        now_no_parse = set(prev.has_readings).intersection(new.no_readings)
-
-        self.now_parses.add_items(now_parses, new)
-        self.now_no_parse.add_items(now_no_parse, prev)
-        self.still_parses_new.add_items(still_parses, new)
-        self.still_parses_prev.add_items(still_parses, prev)
-
-    def add_attribute_counts(self, total_counts, this_profile):
-        """Add the number of items each attribute occurs in """
-        for item in this_profile.items.values():
-            if item.used:
-                for attribute in item.attributes:
-                    total_counts[attribute] += 1
+        now_parses, now_no_parse, still_parses = changes
+        self.now_parses.add_items(now_parses, new, rows)
+        self.now_no_parse.add_items(now_no_parse, prev, rows)
+        self.still_parses_new.add_items(still_parses, new, rows)
+        self.still_parses_prev.add_items(still_parses, prev, rows)
 
     def get_attributes(self):
-        attributes = set(self.prev_attribute_counts.keys() + 
-                       self.new_attribute_counts.keys())
+        attribute_ids = set(self.prev_attribute_counts.keys() + 
+                            self.new_attribute_counts.keys())
+        attribute_ids = sorted(attribute_ids, key=VOCAB.__getitem__)
         prev_parses = (self.now_no_parse.num_used_items + 
                        self.still_parses_prev.num_used_items)
         new_parses = (self.now_parses.num_used_items + 
                       self.still_parses_new.num_used_items)
-        self.attributes = {}
-        for attribute in attributes:
-            self.attributes[attribute] = Attribute(attribute, 
-                                             self.prev_attribute_counts[attribute], 
-                                             self.new_attribute_counts[attribute], 
-                                             prev_parses, new_parses, 
-                                             self.prev_grammar.types, 
-                                             self.new_grammar.types,
-                                             self.gopts.weighting)
+        self.attributes = AttributeTable(
+            attribute_ids, 
+            [self.prev_attribute_counts.get(i, 0) for i in attribute_ids],
+            [self.new_attribute_counts.get(i, 0) for i in attribute_ids],
+            prev_parses, new_parses, 
+            self.prev_grammar.types, self.new_grammar.types,
+            self.gopts.weighting)
+
+
+class StoredItem:
+    """The details of an item kept in an ItemStore."""
+    def __init__(self, item_id, wf, length, profile_name, text, tot_readings):
+        self.id = item_id
+        self.wf = wf
+        self.length = length
+        self.profile_name = profile_name
+        self.text = text
+        self.tot_readings = tot_readings
+
+
+class ItemStore:
+    """
+    Used in place of Pdiff.item_list when streaming. Just the details
+    of each pair of items needed for the items page are kept, in a
+    temporary file, so that the profiles can be let go of once they
+    have been processed.
+    """
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.offsets = array('l')
+        self.item_ids = array('l')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, entry):
+        prev_item, new_item, row = entry
+        self.file.seek(0, os.SEEK_END)
+        self.offsets.append(self.file.tell())
+        self.item_ids.append(prev_item.id)
+        record = (prev_item.id, prev_item.wf, prev_item.length, 
+                  prev_item.profile_name, prev_item.text, 
+                  prev_item.tot_readings, new_item.tot_readings)
+        pickle.dump(record, self.file, pickle.HIGHEST_PROTOCOL)
+
+    def sorted_items(self):
+        """
+        Generator yielding a StoredItem for the previous and new item
+        and the row of each pair, sorted by item ID.
+        """
+        rows = sorted(xrange(len(self)), key=self.item_ids.__getitem__)
+        for row in rows:
+            self.file.seek(self.offsets[row])
+            (item_id, wf, length, profile_name, text, prev_readings, 
+             new_readings) = pickle.load(self.file)
+            prev_item = StoredItem(item_id, wf, length, profile_name, text, 
+                                   prev_readings)
+            new_item = StoredItem(item_id, wf, length, profile_name, text, 
+                                  new_readings)
+            yield prev_item, new_item, row
+
+
+def get_parse_changes(prev, new):
+    """
+    Returns lists of the IDs of items that now parse, that no longer
+    parse and that still parse. Note that parse -> parse only includes
+    those items whose number of readings has changed.
+    """
+    still_parses = set(prev.has_readings).intersection(new.has_readings)
+    still_parses = [i for i in still_parses 
+                    if prev[i].tot_readings != new[i].tot_readings]
+    now_parses = set(prev.no_readings).intersection(new.has_readings)
+    now_no_parse = set(prev.has_readings).intersection(new.no_readings)
+    return list(now_parses), list(now_no_parse), still_parses
+
+
+def load_profile_pair(profile_name, prev_grammar, new_grammar, gopts):
+    # the new profile goes through the same results in the same order
+    # as the previous one, so the derivations scanned for the previous
+    # one are kept until the new one is loaded, however many there are
+    DERIVATIONS.keep()
+    prev = cache.load_profile(profile_name, prev_grammar, gopts)
+    DERIVATIONS.stop_keeping()
+    new = cache.load_profile(profile_name, new_grammar, gopts)
+    DERIVATIONS.release()
+    return prev, new, get_parse_changes(prev, new)
+
+
+def load_profile_pairs(profile_names, prev_grammar, new_grammar, gopts):
+    """
+    Generator yielding the previous and new Profiles and their parse
+    changes for each profile name, in the order of the profile names,
+    loaded by a pool of worker processes when there is more than one
+    job.
+    """
+    jobs = min(gopts.jobs, len(profile_names))
+    if jobs <= 1:
+        for profile_name in profile_names:
+            yield load_profile_pair(profile_name, prev_grammar, new_grammar,
+                                    gopts)
+        return
+
+    initargs = (prev_grammar, new_grammar, gopts)
+    for prev, new, changes in imap_profiles(load_profile_pair_worker, 
+                                            profile_names, jobs, initargs):
+        prev.attach(prev_grammar, gopts)
+        new.attach(new_grammar, gopts)
+        yield prev, new, changes
+
+
+def load_profiles(profile_names, grammar, gopts):
+    """
+    Generator yielding the Profile of the grammar for each profile
+    name, in the order of the profile names, loaded by a pool of
+    worker processes when there is more than one job.
+    """
+    jobs = min(gopts.jobs, len(profile_names))
+    if jobs <= 1:
+        for profile_name in profile_names:
+            yield cache.load_profile(profile_name, grammar, gopts)
+        return
+
+    for profile, kept in imap_profiles(load_profile_worker, profile_names, 
+                                       jobs, (grammar, gopts)):
+        profile.attach(grammar, gopts)
+        DERIVATIONS.add_kept(kept)
+        yield profile
+
+
+def imap_profiles(worker, profile_names, jobs, initargs):
+    """
+    Generator yielding the result of the worker function for each
+    profile name, computed by a pool of processes.
+    """
+    # workers are forked, so the grammars are inherited rather than
+    # being pickled for every task
+    pool = multiprocessing.Pool(jobs, init_worker, initargs)
+    try:
+        for result in pool.imap(worker, profile_names):
+            yield result
+    except WorkerExit as err:
+        pool.terminate()
+        sys.exit(err.code)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class WorkerExit(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+worker_args = None
+
+
+def init_worker(*args):
+    global worker_args
+    worker_args = args
+
+
+def load_profile_pair_worker(profile_name):
+    return call_worker(load_profile_pair, profile_name)
+
+
+def load_profile_worker(profile_name):
+    profile = call_worker(cache.load_profile, profile_name)
+    # derivations kept by the worker are passed back, to be kept by the
+    # parent for the profiles of the other grammar
+    return profile, DERIVATIONS.take_kept()
+
+
+def call_worker(func, profile_name):
+    try:
+        return func(profile_name, *worker_args)
+    except SystemExit as err:
+        # Profile reports fatal errors itself and then exits, which
+        # would otherwise kill the worker and leave the pool hanging
+        raise WorkerExit(err.code)
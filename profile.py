@@ -1,20 +1,65 @@
 from __future__ import division
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 import os
 import re
 import sys
+import heapq
+import hashlib
 import logon
 import itertools
+from array import array
 
 
 NEWNAMES = True
 
+# the number of scanned derivations to hold on to; the same derivations
+# tend to come up for the same items with both grammars
+DERIVATION_CACHE_SIZE = 20000
+
+
+class Vocabulary:
+    """
+    Maps attribute names onto dense integer IDs, so that attributes can
+    be stored and counted as integers, only being resolved back into
+    names for output. IDs are assigned in the order names are first
+    seen, so they are only meaningful within a single process.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, attribute_id):
+        return self.names[attribute_id]
+
+    def intern(self, name):
+        try:
+            return self.ids[name]
+        except KeyError:
+            attribute_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+            return attribute_id
+
+    def resolve(self, attribute_ids):
+        return [self.names[i] for i in attribute_ids]
+
+
+# shared by all the profiles of both grammars
+VOCAB = Vocabulary()
+
 
 class ParseResult:
     def __init__(self, score):
         self.score = score
-        self.attributes = set()
+        # sorted array of the IDs of the attributes in this result
+        self.attribute_ids = array('i')
+
+    @property
+    def attributes(self):
+        return set(VOCAB.resolve(self.attribute_ids))
 
 class Item:
     def __init__(self, item_id, text, wf, length, profile_name, grammar):
@@ -29,13 +74,37 @@ class Item:
         self.used = True
         self.error = None
 
+    @property
+    def attribute_ids(self):
+        """
+        The attribute IDs of each of the item's results, one after the
+        other, so an ID occurs once for every result containing it.
+        """
+        if len(self.results) == 1:
+            return self.results[0].attribute_ids
+        attribute_ids = array('i')
+        for result in self.results:
+            attribute_ids.extend(result.attribute_ids)
+        return attribute_ids
+
     @property
     def attributes(self):
-        return list(itertools.chain(*(r.attributes for r in self.results)))
+        # sorted so that the order doesn't depend on the order in which
+        # the attributes were interned
+        return list(itertools.chain(*(sorted(r.attributes) 
+                                      for r in self.results)))
+
+    def __getstate__(self):
+        # the grammar is shared by every item in a profile, so it is
+        # left out and put back by Profile.attach
+        state = self.__dict__.copy()
+        del state['grammar']
+        return state
 
 
 class ItemError(Exception):
     def __init__(self, kind, msg):
+        Exception.__init__(self, kind, msg)
         self.kind = kind
         self.msg = msg
 
@@ -51,7 +120,7 @@ class Profile:
     Contains the results and information pertaining to the results of
     parsing a single TSDB profile 
     """
-    def __init__(self, profile_name, grammar, gopts): 
+    def __init__(self, profile_name, grammar, gopts, profile_path=None): 
         self.name = profile_name
         self.grammar = grammar 
         self.gopts = gopts
@@ -69,7 +138,9 @@ class Profile:
         self.other_type_counts = defaultdict(int)
 
         # initialise grammar names and paths etc
-        self.profile_path = self.get_profile_path()
+        if profile_path is None:
+            profile_path = self.get_profile_path()
+        self.profile_path = profile_path
         self.tsdb_profile = logon.TsdbProfile(self.profile_path)
         if self.grammar.name == 'erg' and self.grammar.version == '0907':
             self.old_erg = True
@@ -78,55 +149,64 @@ class Profile:
         # process the contents of the profile
         try:
             self.items = self.get_items()
-            nbest_results = self.locate_nbest_results()
-            self.process_results(nbest_results)
+            self.process_results()
         except logon.TsdbError, err:
             print >>sys.stderr, err.msg
             print >>sys.stderr, "gDelta halted."
             sys.exit(2)
 
     def get_profile_path(self):
-        def select_dirs(path, dirs):
-            print "There is more than than one profile output in " \
-                "{0}\nPlease select one of the following:".format(path)
-            for i,d in enumerate(dirs):
-                print "{0}) {1}".format(i+1, d)
-            try:
-                num = int(raw_input())
-                choice = dirs[num-1]
-            except ValueError, IndexError:
-                print "That's not a valid option."
-                select_dirs(path, dirs, msg=False)
-            return choice
-
-        if self.gopts.gold:
-            path = os.path.join(self.grammar.path, 'tsdb', 'gold', self.name)
-        else:
-            path = os.path.join(self.gopts.tsdb_path, self.grammar.name, 
-                             self.grammar.version, self.name)
-
-        if os.path.exists(os.path.join(path, 'relations')):
-            # support bare profiles not in standard yy-mm-dd/pet subdirectories
-            profile_path = path
-        else:
-            try:
-                dirs = sorted(os.listdir(path))
-                if not self.gopts.ask_profile or len(dirs) == 1:
-                    # if more than one set of results, choose most recent
-                    date = dirs[-1]
-                else:
-                    date = select_dirs(path, dirs)
-            except OSError, err:
-                msg = "No such TSDB profile '{0}'"
-                print >>sys.stderr, msg.format(err.filename)
-                print >>sys.stderr, "For help use -h or --help"
-                sys.exit(2)
-            profile_path = os.path.join(path, date, 'ace') 
-        return profile_path
+        return find_profile_path(self.name, self.grammar, self.gopts)
 
     def __getitem__(self,id):
         return self.items[id]
 
+    def __getstate__(self):
+        # Profiles are pickled when sent back from worker processes;
+        # the grammar and options are left out and put back by attach
+        state = self.__dict__.copy()
+        for name in ('grammar', 'gopts', 'old_rulenames'):
+            state.pop(name, None)
+        # attribute IDs are only meaningful in the process that
+        # assigned them, so the names go along with them
+        state['attribute_names'] = VOCAB.names[:]
+        return state
+
+    def __setstate__(self, state):
+        names = state.pop('attribute_names')
+        self.__dict__.update(state)
+        self.remap_attributes([VOCAB.intern(name) for name in names])
+
+    def remap_attributes(self, mapping):
+        """
+        Replace every attribute ID with mapping[ID], used to translate
+        the IDs of an unpickled Profile into those of this process.
+        """
+        for item in self.items.itervalues():
+            for result in item.results:
+                result.attribute_ids = array('i', sorted(
+                        mapping[i] for i in result.attribute_ids))
+
+    def attach(self, grammar, gopts):
+        """Reattach the grammar and options of an unpickled Profile."""
+        self.grammar = grammar
+        self.gopts = gopts
+        for item in self.items.itervalues():
+            item.grammar = grammar
+
+    def read_rows(self, table_name, columns, key_column):
+        """
+        Returns an iterator over the rows of the table. If only some
+        items are being compared, the rows for those items are located
+        using an index over the key column instead of scanning the
+        whole table.
+        """
+        tr = self.tsdb_profile.read_table(table_name)
+        if self.gopts.item_ids is None:
+            return tr.read_rows(columns)
+        return tr.read_keyed_rows(columns, key_column, self.gopts.item_ids,
+                                  self.gopts.cache_dir)
+
     def get_items(self):
         """ Returns a dictionary of Items indexed by item ID.  first
             processes the item file for information about items in the
@@ -134,111 +214,79 @@ class Profile:
             number of readings.
         """
         items = {}
-        tr = self.tsdb_profile.read_table('item')
-        with tr.open() as f:
-            for line in f:
-                fields = tr.read_fields(line.strip())
-                item_id = fields['i-id']
-                items[item_id] = Item(item_id, fields['i-input'], 
-                                      bool(fields['i-wf']), fields['i-length'],
-                                      self.name, self.grammar)
-
-        tr = self.tsdb_profile.read_table('parse')
-        with tr.open() as f:
-            for line in f:
-                fields = tr.read_fields(line.strip())
-                item = items[fields['i-id']] 
-                item.tot_readings = fields['readings']
-                error_msg = fields['error']
-
-                if error_msg != None:
-                    error = ItemError("parse", error_msg)
-                    item.error = error
-                    if not self.gopts.use_errors:
-                        item.used = False
+        columns = ('i-id', 'i-input', 'i-wf', 'i-length')
+        rows = self.read_rows('item', columns, 'i-id')
+        for item_id, text, wf, length in rows:
+            items[item_id] = Item(item_id, text, bool(wf), length, 
+                                  self.name, self.grammar)
+
+        columns = ('i-id', 'readings', 'error')
+        rows = self.read_rows('parse', columns, 'i-id')
+        for item_id, readings, error_msg in rows:
+            item = items[item_id] 
+            item.tot_readings = readings
+            if error_msg != None:
+                error = ItemError("parse", error_msg)
+                item.error = error
+                if not self.gopts.use_errors:
+                    item.used = False
         return items
 
-    def locate_nbest_results(self):
-        """ 
-        Find the n best scores for items that have readings
-        and recored this information in the Item object. First
-        find the score for each result then add the nbest results
-        for each item to total results.
+    def process_results(self):
+        """
+        Make a single pass over the results file, keeping a bounded
+        heap of the n best results for each item, then parse the
+        derivations of only those results that made the cut. Results
+        within an item are processed in file order, as before.
         """
-        scores = defaultdict(list)
-        tr = self.tsdb_profile.read_table('result')
-        with tr.open() as f:
-            for line in f:
-                fields = tr.read_fields(line.strip())
-                item_id = fields['parse-id']
-                result_id = fields['result-id']
-                flags = fields['flags']
-                score = float(flags.strip('()').split()[-1])
-                scores[item_id].append((score, result_id))
-
-        # turns out the results for each item are already sorted
-        # in the results file, so part of this is probably uneccesary 
-        nbest_results = set()
+        nbest = self.gopts.nbest
+        heaps = defaultdict(list)
+        num_results = defaultdict(int)
+        columns = ('parse-id', 'result-id', 'flags', 'derivation')
+        rows = self.read_rows('result', columns, 'parse-id')
+        for position, (item_id, result_id, flags, derivation) in enumerate(rows):
+            score = float(flags.strip('()').split()[-1])
+            num_results[item_id] += 1
+            # negating the position means that ties on score are
+            # won by the earlier result, like a stable sort would
+            entry = (score, -position, result_id, derivation)
+            heap = heaps[item_id]
+            if len(heap) < nbest:
+                heapq.heappush(heap, entry)
+            elif heap and entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
         for item_id, item in self.items.iteritems():
-            item_scores = scores[item_id]
-            item.num_results = len(item_scores)
-            item_scores.sort(reverse=True, key=lambda x:x[0])
-            nbest_results.update([id for score, id in 
-                                  item_scores[:self.gopts.nbest]])
+            item.num_results = num_results[item_id]
             self.tot_readings += item.tot_readings
-            
             if item.tot_readings > 0:
                 self.has_readings.append(item_id)
             else:
                 self.no_readings.append(item_id)
-        return nbest_results
 
-    def process_results(self, nbest_results):
-        """
-        Process the results file again, parsing the nbest results for
-        each item and creating a Result item.  
+        for item_id, heap in heaps.iteritems():
+            item = self.items[item_id]
+            heap.sort(key=lambda x:x[1], reverse=True)
+            for score, position, result_id, derivation in heap:
+                self.add_result(item, result_id, score, derivation)
 
-        Since results are sorted by score, we could actually process
-        the results file in one pass...
-        """
-        tr = self.tsdb_profile.read_table('result')
-        with tr.open() as f:
-            for line in f:
-                fields = tr.read_fields(line.strip())
-                item_id = fields['parse-id']
-                result_id = fields['result-id']
-                derivation = fields['derivation']
-                flags = fields['flags']
-                score = float(flags.strip('()').split()[-1])
-                item = self.items[item_id]
-                if result_id not in nbest_results:
-                    continue
-                try:
-                    parse = parse_derivation(derivation)
-                    result = ParseResult(score)
-                    item.results.append(result)
-                    self.add_result_attributes(parse, result, item)
-                except DerivationError as err:
-                    root_node = derivation.strip('(').split()[0]
-                    msg = u"resultID: {0}, root node: {1}".format(result_id, 
-                                                                 root_node)
-                    error = ItemError("derivation", msg)
-                    item.error = error
-                    item.used = False
+    def add_result(self, item, result_id, score, derivation):
+        try:
+            rules, lexemes = scan_derivation_cached(derivation)
+            result = ParseResult(score)
+            item.results.append(result)
+            self.add_result_attributes(rules, lexemes, result, item)
+        except DerivationError as err:
+            root_node = derivation.strip('(').split()[0]
+            msg = u"resultID: {0}, root node: {1}".format(result_id, 
+                                                         root_node)
+            error = ItemError("derivation", msg)
+            item.error = error
+            item.used = False
                                 
-    def add_result_attributes(self, parse, result, item):
-        node, children = parse
-        if children == []:
-            try:
-                lex_type = self.grammar.lexicon[node]
-                self.lex_type_counts[lex_type] += 1
-                result.attributes.add(lex_type)
-            except KeyError, key:
-                msg = u"lex item: '{0}'".format(node)
-                error = ItemError("lexicon", msg)
-                item.error = error
-                item.used = False
-        else:
+    def add_result_attributes(self, rules, lexemes, result, item):
+        attribute_ids = set()
+        for node in rules:
             # Map old onto new rulename if necessary
             # Should try to not check for every node in the profile
             if NEWNAMES and self.old_erg:
@@ -249,9 +297,18 @@ class Profile:
                         msg = u"No new type found in mapping: {0} in {1}"
                         print msg.format(node, self.grammar.name)
             self.other_type_counts[node] += 1
-            result.attributes.add(node)
-            for child in children:
-                self.add_result_attributes(child, result, item)
+            attribute_ids.add(VOCAB.intern(node))
+        for node in lexemes:
+            try:
+                lex_type = self.grammar.lexicon[node]
+                self.lex_type_counts[lex_type] += 1
+                attribute_ids.add(VOCAB.intern(lex_type))
+            except KeyError, key:
+                msg = u"lex item: '{0}'".format(node)
+                error = ItemError("lexicon", msg)
+                item.error = error
+                item.used = False
+        result.attribute_ids = array('i', sorted(attribute_ids))
 
     def get_old_rulenames(self):
         old_rulenames = {}
@@ -264,54 +321,222 @@ class Profile:
         return old_rulenames
 
 
-def parse_derivation(der_string):
+def find_profile_path(profile_name, grammar, gopts):
+    """
+    Returns the path to the TSDB profile containing the results of
+    parsing the named profile with the grammar.
+    """
+    def select_dirs(path, dirs):
+        print "There is more than than one profile output in " \
+            "{0}\nPlease select one of the following:".format(path)
+        for i,d in enumerate(dirs):
+            print "{0}) {1}".format(i+1, d)
+        try:
+            num = int(raw_input())
+            choice = dirs[num-1]
+        except ValueError, IndexError:
+            print "That's not a valid option."
+            select_dirs(path, dirs, msg=False)
+        return choice
+
+    if gopts.gold:
+        path = os.path.join(grammar.path, 'tsdb', 'gold', profile_name)
+    else:
+        path = os.path.join(gopts.tsdb_path, grammar.name, 
+                            grammar.version, profile_name)
+
+    if os.path.exists(os.path.join(path, 'relations')):
+        # support bare profiles not in standard yy-mm-dd/pet subdirectories
+        profile_path = path
+    else:
+        try:
+            dirs = sorted(os.listdir(path))
+            if not gopts.ask_profile or len(dirs) == 1:
+                # if more than one set of results, choose most recent
+                date = dirs[-1]
+            else:
+                date = select_dirs(path, dirs)
+        except OSError, err:
+            msg = "No such TSDB profile '{0}'"
+            print >>sys.stderr, msg.format(err.filename)
+            print >>sys.stderr, "For help use -h or --help"
+            sys.exit(2)
+        profile_path = os.path.join(path, date, 'ace') 
+    return profile_path
+
+
+# A token is either an lparen followed by a node or an rparen, where a
+# node is made up of quoted strings and any other non-paren characters
+TOKEN_RE = re.compile(r'\(("[^"]+"|[^()"]+)+|\)')
+
+
+def scan_derivation(der_string):
+    """
+    Scans a derivation in one pass, returning a list of the names of
+    the rules and a list of the lexical entries it contains, each in
+    preorder. Lexical entries are the nodes with no children other
+    than the token strings. No tree is built; the only state kept is a
+    stack of the open nodes. Raises DerivationError if the derivation
+    is malformed.
+    """
     der_string = der_string.replace('\\"', '__ESCAPEDQUOTE__')
-    lparen, rparen = '()'
-    open_re, close_re = re.escape(lparen), re.escape(rparen) 
-    node_re = r'("[^"]+"|[^{0}{1}"]+)+'.format(open_re, close_re)       
-    token_re = re.compile('{0}{1}|{2}'.format(open_re, node_re, close_re))
-    # Walk through each token, updating a stack of trees. 
-    # Where a token is either lparen + node or rparen.
-    stack = [(None, [])] # list of (node, children) 
-    for match in token_re.finditer(der_string): 
-        token = match.group() 
+    names = []
+    is_rule = []
+    # indices into names of the open nodes, where None marks a token
+    # string, the contents of which are ignored
+    stack = []
+    num_trees = 0
+    for match in TOKEN_RE.finditer(der_string):
+        token = match.group()
         # Leaf node 
-        if token[:2] == lparen + '"': 
-            if len(stack) == 1: 
-                parse_error(der_string, match, lparen) 
-            stack.append(('leaf', []))
+        if token[:2] == '("':
+            if not stack:
+                parse_error(der_string, match, '(')
+            stack.append(None)
         # Beginning of a tree/subtree 
-        elif token[0] == lparen: 
-            if len(stack) == 1 and len(stack[0][1]) > 0: 
-                parse_error(der_string, match, 'end-of-string') 
-            atts = token[1:].strip().split() 
+        elif token[0] == '(':
+            if not stack and num_trees > 0:
+                parse_error(der_string, match, 'end-of-string')
+            atts = token[1:].split()
             if len(atts) > 1:
                 node = atts[1]
             elif len(atts) == 1:
                 node = atts[0]
             else:
-                parse_error(der_string, match, 'empty-node') 
-            stack.append((node, [])) 
+                parse_error(der_string, match, 'empty-node')
+            if (stack and stack[-1] is None) or node == 'leaf':
+                stack.append(None)
+            else:
+                if stack:
+                    is_rule[stack[-1]] = True
+                stack.append(len(names))
+                names.append(node)
+                is_rule.append(False)
         # End of a tree/subtree 
-        elif token == rparen: 
-            if len(stack) == 1: 
-                if len(stack[0][1]) == 0: 
-                    parse_error(der_string, match, lparen) 
-                else: 
-                    parse_error(der_string, match, 'end-of-string') 
-            node, children = stack.pop() 
-            if node != 'leaf':
-                stack[-1][1].append((node, children)) 
-      # check that we got exactly one complete tree. 
-    if len(stack) > 1: 
-        parse_error(der_string, 'end-of-string', rparen) 
-    elif len(stack[0][1]) == 0: 
-        parse_error(der_string, 'end-of-string', lparen) 
-    else: 
-        assert stack[0][0] is None 
-        assert len(stack[0][1]) == 1 
-    tree = stack[0][1][0] 
-    return tree
+        else:
+            if not stack:
+                if num_trees == 0:
+                    parse_error(der_string, match, '(')
+                else:
+                    parse_error(der_string, match, 'end-of-string')
+            index = stack.pop()
+            if not stack and index is not None:
+                num_trees += 1
+    # check that we got exactly one complete tree. 
+    if stack:
+        parse_error(der_string, 'end-of-string', ')')
+    elif num_trees == 0:
+        parse_error(der_string, 'end-of-string', '(')
+    rules = [n for n, r in itertools.izip(names, is_rule) if r]
+    lexemes = [n for n, r in itertools.izip(names, is_rule) if not r]
+    return rules, lexemes
+
+
+class LRUCache:
+    """
+    A mapping holding at most size entries, which discards the least
+    recently used entry to make room for new ones.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return None
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class DerivationCache:
+    """
+    Scanned derivations, keyed by a digest of the derivation string.
+    Recently scanned derivations are held in a bounded LRUCache. The
+    profiles of a grammar are often loaded in full before those of
+    another grammar go through the same results in the same order, by
+    which time the LRUCache would have discarded the derivations they
+    have in common. So while the first grammar's profiles are loaded,
+    every derivation they scan can also be kept, until the other
+    grammar's profiles have been loaded and the kept derivations are
+    released.
+    """
+    def __init__(self, size):
+        self.recent = LRUCache(size)
+        self.kept = {}
+        self.keeping = False
+
+    def get(self, key):
+        scanned = self.kept.get(key)
+        if scanned is None:
+            scanned = self.recent.get(key)
+        return scanned
+
+    def put(self, key, scanned):
+        self.recent.put(key, scanned)
+        if self.keeping:
+            self.kept[key] = scanned
+
+    def keep(self):
+        """Starts keeping every derivation that is scanned."""
+        self.kept = {}
+        self.keeping = True
+
+    def stop_keeping(self):
+        """
+        Stops adding to the kept derivations, which are still used
+        until they are released.
+        """
+        self.keeping = False
+
+    def release(self):
+        self.kept = {}
+        self.keeping = False
+
+    def take_kept(self):
+        """
+        Returns the derivations kept so far and starts a fresh set, so
+        that a worker process can pass them back to be kept by its
+        parent with add_kept.
+        """
+        if not self.keeping:
+            return {}
+        kept = self.kept
+        self.kept = {}
+        return kept
+
+    def add_kept(self, kept):
+        self.kept.update(kept)
+
+
+# shared by the profiles of both grammars. Only the structure of each
+# derivation is kept, as lexical entries must still be looked up in
+# the lexicon of the grammar being processed.
+DERIVATIONS = DerivationCache(DERIVATION_CACHE_SIZE)
+
+
+def scan_derivation_cached(der_string):
+    """
+    Like scan_derivation, but reuses the result of scanning the same
+    derivation string recently, or while derivations are being kept.
+    """
+    key = hashlib.md5(der_string.encode('utf-8')).digest()
+    scanned = DERIVATIONS.get(key)
+    if scanned is None:
+        scanned = scan_derivation(der_string)
+    # even if it was found, so that it is recent, and kept if need be
+    DERIVATIONS.put(key, scanned)
+    return scanned
 
 
 def parse_error(string, match, expecting):